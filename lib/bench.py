@@ -0,0 +1,314 @@
+"""
+Copyright 2008 Ryan Hoffman
+
+This file is part of Robot Toast.
+
+Robot Toast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Robot Toast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
+"""
+#------------------------------------------------------------------------------
+#   Imports
+#------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import random
+import null_gl
+import level_data
+from level_data import SOLID, CHECKPOINT
+
+
+#------------------------------------------------------------------------------
+#   Bench
+#------------------------------------------------------------------------------
+
+def run(state_name='Level1', frames=1000, interval=16):
+	"""
+	Tick a game state frames times without a window or GPU
+
+	The state is looked up in gamestate, then menu. Nothing is drawn, SDL
+	uses its dummy video and audio drivers and OpenGL is a NullGL. Print
+	load time, frame times and GL calls per frame
+	"""
+	os.environ['SDL_VIDEODRIVER'] = 'dummy'
+	os.environ['SDL_AUDIODRIVER'] = 'dummy'
+	gl = null_gl.install()
+	import pygame
+	from main import Main
+	import gamestate
+	import menu
+
+	pygame.init()
+	pygame.font.init()
+	pygame.mixer.init()
+	game = Main()
+	game.screen = pygame.display.set_mode((game.res_x, game.res_y))
+	game.stick = False
+	game.setup_gl()
+	game.running = True
+
+	try:
+		state_class = getattr(gamestate, state_name)
+	except AttributeError:
+		try:
+			state_class = getattr(menu, state_name)
+		except AttributeError:
+			sys.exit("No game state called %s" % state_name)
+	start = time.time()
+	game.add_game_state(state_class(game))
+	print "%s loaded in %.3fs" % (state_name, time.time() - start)
+
+	gl.reset()
+	frame_times = []
+	start = time.time()
+	for frame in range(frames):
+		if not game.running:
+			break
+		frame_start = time.time()
+		game.tick(interval)
+		pygame.event.pump()
+		frame_times.append((time.time() - frame_start) * 1000.0)
+	total = time.time() - start
+
+	if not frame_times:
+		return
+	frame_times.sort()
+	count = len(frame_times)
+	print "%d frames in %.3fs, %.0f frames/s" % (count, total, count / total)
+	print "frame mean %.3fms median %.3fms p95 %.3fms max %.3fms" % \
+		  (sum(frame_times) / count, frame_times[count / 2],
+		   frame_times[int(count * 0.95)], frame_times[-1])
+	print "GL calls per frame:"
+	gl.report(count)
+	pygame.quit()
+
+
+class Tile(object):
+	"""
+	A cell of the baseline collision map, with a dict of properties
+
+	Edges are worked out in __getattr__, as the baseline's BaseEntity did
+	"""
+
+	def __init__(self, grid_x, grid_y, tile_size):
+		self.x = float(grid_x * tile_size)
+		self.y = float(grid_y * tile_size)
+		self.width = tile_size
+		self.height = tile_size
+		self.properties = {}
+
+	def __getattr__(self, name):
+		if name is "left":
+			return self.x
+		if name is "right":
+			return self.x + self.width
+		if name is "top":
+			return self.y + self.height
+		if name is "bottom":
+			return self.y
+
+	def has_property(self, property):
+		return property in self.properties
+
+
+def tile_grid(collision_map, width, height, tile_size):
+	"""
+	Return the baseline collision map, a grid of Tiles
+
+	Each rect adds its property to the cells it covers, snapped to the
+	grid the way the baseline level loader did
+	"""
+	names = dict([(flags, name) for name, flags in level_data.PROPERTY_FLAGS.items()])
+	grid = [[Tile(x, y, tile_size) for y in range(height)] for x in range(width)]
+	for rect in collision_map.rects:
+		x = int(round(rect.left))
+		y = int(round(rect.bottom))
+		grid_x = x / tile_size
+		grid_y = y / tile_size
+		for tile_x in range(grid_x, grid_x + int(round(rect.right - rect.left)) / tile_size):
+			for tile_y in range(grid_y, grid_y + int(round(rect.top - rect.bottom)) / tile_size):
+				try:
+					grid[tile_x][tile_y].properties[names[rect.flags]] = rect.value
+				except IndexError:
+					pass
+	return grid
+
+
+def grid_collide(grid, tile_size, left, bottom, right, top, vx, vy):
+	"""
+	Collide the way actors did in the baseline
+
+	A fresh list of the Tiles under the box, a walk of every tile's
+	property dict, then a pass for each push looking up 'solid'
+	"""
+	tiles = []
+	grid_x1 = int(left / tile_size)
+	grid_x2 = int((right - 0.0001) / tile_size)
+	grid_y1 = int(bottom / tile_size)
+	grid_y2 = int((top - 0.0001) / tile_size)
+	for x in range(grid_x1, grid_x2 + 1):
+		for y in range(grid_y1, grid_y2 + 1):
+			try:
+				tile = grid[x][y]
+			except IndexError:
+				pass
+			else:
+				tiles.append(tile)
+	properties = {}
+	for tile in tiles:
+		for property, value in tile.properties.iteritems():
+			properties[property] = value
+	push_x = 0.0
+	for tile in tiles:
+		if tile.has_property('solid'):
+			diff = 0.0
+			if vx > 0:
+				diff = tile.left - right - 0.0001
+			elif vx < 0:
+				diff = tile.right - left
+			if abs(diff) > abs(push_x):
+				push_x = diff
+	push_y = 0.0
+	for tile in tiles:
+		if tile.has_property('solid'):
+			diff = 0.0
+			if vy < 0:
+				diff = tile.top - bottom
+			elif vy > 0:
+				diff = tile.bottom - top - 0.0001
+			if abs(diff) > abs(push_y):
+				push_y = diff
+	return push_x, push_y, properties
+
+
+def list_collide(collision_map, left, bottom, right, top, vx, vy):
+	"""
+	Collide the way actors did from collision rects, before CollisionMap.collide
+
+	The same collision rects, but a list of them from query, a pass for
+	properties, then one for each push. Results should match collide
+	"""
+	rects = collision_map.query(left, bottom, right, top)
+	flags = 0
+	values = {}
+	for rect in rects:
+		flags |= rect.flags
+		if rect.flags & CHECKPOINT:
+			values['checkpoint'] = rect.value
+	push_x = 0.0
+	for rect in rects:
+		if rect.flags & SOLID:
+			diff = 0.0
+			if vx > 0:
+				diff = rect.left - right - 0.0001
+			elif vx < 0:
+				diff = rect.right - left
+			if abs(diff) > abs(push_x):
+				push_x = diff
+	push_y = 0.0
+	for rect in rects:
+		if rect.flags & SOLID:
+			diff = 0.0
+			if vy < 0:
+				diff = rect.top - bottom
+			elif vy > 0:
+				diff = rect.bottom - top - 0.0001
+			if abs(diff) > abs(push_y):
+				push_y = diff
+	return push_x, push_y, flags, values.get('checkpoint')
+
+
+def best_time(function, args, rounds, repeats):
+	"""Return the best of repeats timings of rounds calls for each of args"""
+	best = None
+	for repeat in range(repeats):
+		start = time.time()
+		for i in xrange(rounds):
+			for arg in args:
+				function(*arg)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+def collision(level_file='level1.svg', calls=100000, repeats=5):
+	"""
+	Time the baseline's tile grid and list_collide against
+	CollisionMap.collide
+
+	Boxes the size of the player are placed around random collision rects
+	of level_file, moving random ways, the same boxes for each. Each is
+	timed repeats times, taking the best. Print microseconds per call and
+	the boxes where list_collide and collide differ. The baseline snapped
+	rects to the grid, so its pushes aren't compared
+	"""
+	data = level_data.load_level(level_file, 32, 512)
+	collision_map = data.collision_map()
+	grid = tile_grid(collision_map, data.grid_w, data.grid_h, data.tile_size)
+	rects = collision_map.rects
+	seed = random.Random(1)
+	boxes = []
+	for i in range(1000):
+		rect = seed.choice(rects)
+		left = seed.uniform(rect.left - 40.0, rect.right + 10.0)
+		bottom = seed.uniform(rect.bottom - 70.0, rect.top + 10.0)
+		boxes.append((left, bottom, left + 30.0, bottom + 62.0, 
+					  seed.choice((-0.5, 0.0, 0.5)), seed.choice((-0.5, 0.0, 0.5))))
+	
+	differ = 0
+	for box in boxes:
+		if list_collide(collision_map, *box) != collision_map.collide(*box):
+			differ += 1
+	
+	rounds = max(calls / len(boxes) / repeats, 1)
+	grid_time = best_time(grid_collide, [(grid, data.tile_size) + box for box in boxes], 
+						  rounds, repeats)
+	list_time = best_time(list_collide, [(collision_map,) + box for box in boxes], 
+						  rounds, repeats)
+	collide_time = best_time(collision_map.collide, boxes, rounds, repeats)
+	
+	count = rounds * len(boxes)
+	print "baseline tile grid: %.2fus per call" % (grid_time * 1000000.0 / count)
+	print "list_collide: %.2fus per call" % (list_time * 1000000.0 / count)
+	print "CollisionMap.collide: %.2fus per call" % (collide_time * 1000000.0 / count)
+	print "%d of %d boxes differ between list_collide and collide" % (differ, len(boxes))
+	data.close()
+
+
+def main(args):
+	"""
+	Run the bench from command line arguments: [state [frames [interval]]]
+	
+	or collision [level file [calls]] for the collision query
+	"""
+	if args and args[0] == 'collision':
+		level_file = 'level1.svg'
+		calls = 100000
+		if len(args) > 1:
+			level_file = args[1]
+		if len(args) > 2:
+			calls = int(args[2])
+		collision(level_file, calls)
+		return
+	state_name = 'Level1'
+	frames = 1000
+	interval = 16
+	if len(args) > 0:
+		state_name = args[0]
+	if len(args) > 1:
+		frames = int(args[1])
+	if len(args) > 2:
+		interval = int(args[2])
+	run(state_name, frames, interval)
@@ -21,6 +21,7 @@ along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
 from sprites import *
+from resource_manager import resources, asset_stats
 import level
 import pygame
 import menu
@@ -42,23 +43,128 @@ class GameState:
 		pygame.mouse.set_visible(False)
 		self.width = self.parent.width
 		self.height = self.parent.height
+		# (texture, s, t) of the frame drawn when paused
+		self.frozen = None
 
 	def start(self):
 		"""Load required resources"""
 		self.running = True
 
 	def stop(self):
-		"""Remove self from parent"""
+		"""Remove self from parent and release its resources"""
 		self.running = False
 		self.parent.rem_game_state(self)
+		self.thaw()
+		resources.release(self)
 
 	def handle_event(self, event):
 		"""Handle events specific to game state"""
 		pass
 
-	def tick(self, interval):
-		"""Functions to execute every frame"""
+	def update(self, interval):
+		"""Advance the state by one simulation step of interval milliseconds"""
 		pass
+		
+	def draw(self, blend=1.0):
+		"""
+		Draw the state
+		
+		blend is how far the frame is between the last simulation step and
+		the next, from 0.0 to 1.0, for interpolating movement
+		"""
+		pass
+		
+	def static(self):
+		"""
+		Return True if a tick would change nothing, so the frame can be skipped
+		
+		Paused states are static once frozen
+		"""
+		return not self.running and self.frozen is not None
+		
+	def paused_tick(self):
+		"""Draw the first paused frame and copy it, then draw the copy"""
+		if self.frozen is None:
+			self.draw()
+			self.frozen = media_manager.capture_texture(self.parent.res_x, self.parent.res_y)
+			return
+		texture, s, t = self.frozen
+		glMatrixMode(GL_PROJECTION)
+		glLoadIdentity()
+		gluOrtho2D(0.0, self.width, 0.0, self.height)
+		glMatrixMode(GL_MODELVIEW)
+		glLoadIdentity()
+		glColor4f(1.0, 1.0, 1.0, 1.0)
+		glBindTexture(GL_TEXTURE_2D, texture)
+		glCallList(model_manager.untextured_quad('frozen', self.width, self.height, 
+												 ((0.0, 0.0), (s, 0.0), (s, t), (0.0, t))))
+		
+	def thaw(self):
+		"""Drop the paused frame"""
+		if self.frozen is not None:
+			resources.delete('texture', self.frozen[0])
+			self.frozen = None
+
+
+#------------------------------------------------------------------------------
+#   Loading
+#------------------------------------------------------------------------------
+
+class Loading(GameState):
+	"""
+	Build a game state over several frames while showing progress
+	
+	game_class.iter_load(parent) is stepped until budget milliseconds have
+	passed each frame, then game_class(parent) is added in place of self.
+	"""
+	
+	def __init__(self, parent, game_class, budget=8):
+		GameState.__init__(self, parent)
+		self.game_class = game_class
+		self.budget = budget
+		self.progress = 0.0
+		self.alpha = 0.0
+		try:
+			self.stages = game_class.iter_load(parent)
+		except AttributeError:
+			self.stages = iter(())
+		
+		# Sprites
+		self.g_text = GLSpriteGroup()
+		self.g_text.add(GLText('Loading', self.width - 40.0, 40.0, size=20, halign='right'))
+		self.bar = ColorBackground(self.width - 340.0, 30.0, 300.0, 4.0, (41, 45, 111))
+		
+	def update(self, interval):
+		"""Fade in"""
+		GameState.update(self, interval)
+		self.alpha += interval / 300.0
+		if self.alpha > 1.0:
+			self.alpha = 1.0
+		
+	def draw(self, blend=1.0):
+		"""
+		Load until the frame budget runs out, then draw progress
+		
+		Loading goes by frames rather than simulation steps, so a frame
+		never spends more than budget milliseconds on it
+		"""
+		deadline = pygame.time.get_ticks() + self.budget
+		while pygame.time.get_ticks() < deadline:
+			try:
+				self.progress = self.stages.next()
+			except StopIteration:
+				self.parent.add_game_state(self.game_class(self.parent))
+				self.stop()
+				return
+		
+		self.g_text.draw(alpha=self.alpha)
+		glColor4f(1.0, 1.0, 1.0, self.alpha)
+		glMatrixMode(GL_MODELVIEW)
+		glLoadIdentity()
+		glTranslate(self.bar.x, self.bar.y, 0.0)
+		glScalef(self.progress, 1.0, 1.0)
+		glCallList(self.bar.model)
+		glColor4f(1.0, 1.0, 1.0, 1.0)
 
 
 #------------------------------------------------------------------------------
@@ -68,6 +174,12 @@ class GameState:
 class Game(GameState):
 	"""Base Gameplay"""
 	
+	# Level and music files, set by each level
+	level_file = None
+	music_file = None
+	# (image, size, tile_scale) of each parallax background, furthest first
+	backgrounds = ()
+	
 	def __init__(self, parent):
 		"""self.level and self.player must be defined before calling init"""
 		GameState.__init__(self, parent)
@@ -77,6 +189,9 @@ class Game(GameState):
 		self.g_layer2 = GLSpriteGroup()
 		self.g_transition = GLSpriteGroup()
 		
+		# Positions before the last simulation step
+		self.interpolator = Interpolator()
+		
 		# Entities
 		self.spawn_points = self.level.load_entities('PLAYERSTART')
 		self.checkpoint = self.spawn_points['1']
@@ -84,7 +199,7 @@ class Game(GameState):
 		# Sprites
 		transition_player = ImageBackground(self.checkpoint.x - 16.5, 
 											self.checkpoint.y - 34.0,
-											64.0, 128.0, 'ninjabot_transition.png')
+											64.0, 128.0, 'ninjabot_transition.png', owner=self)
 		
 		# Add Sprites to Groups
 		self.g_transition.add(transition_player)
@@ -97,6 +212,9 @@ class Game(GameState):
 		cam_y = transition_player.centery + 21.0
 		self.camera = Camera(cam_x, cam_y, 800.0, 600.0, self.level.right, self.level.top, self.player)
 		self.camera.start_transition(into=True)
+		self.parallax = ParallaxStack(self.camera, 
+			[ImageBackground(0, 0, size, size, image, tile_scale=tile_scale, owner=self)
+			 for image, size, tile_scale in self.backgrounds])
 		self.player_alpha = 0.0
 		self.background_alpha = 0.0
 		self.transition_alpha = 1.0
@@ -118,14 +236,53 @@ class Game(GameState):
 		self.leftlock = False
 		self.rightlock = False
 		
+	@classmethod
+	def images(cls):
+		"""Return names of the images drawn besides level tiles"""
+		images = [image for image, size, tile_scale in cls.backgrounds]
+		images.append('ninjabot_transition.png')
+		images.extend(StickDude.totaltextures)
+		images.extend(('grapple_rod.png', 'particle.png'))
+		return images
+		
+	@classmethod
+	def loaders(cls):
+		"""Return functions loading music, for a level preloader"""
+		loaders = []
+		if cls.music_file is not None:
+			loaders.append(lambda: media_manager.load_sound(cls.music_file))
+		return loaders
+		
+	@classmethod
+	def iter_load(cls, parent):
+		"""
+		Load level resources a step at a time for the Loading state
+		
+		Yields progress from 0.0 to 1.0, the state itself is built afterwards
+		and picks up the finished level through level.get_level
+		"""
+		# Building the level, which may mean compiling it, and decoding
+		# images and music are long calls, keep them off the main thread
+		images = cls.images()
+		level.preload_level(cls.level_file, images, *cls.loaders())
+		while not level.wait_for_level(cls.level_file, 0.002):
+			yield 0.0
+		new_level = level.get_level(cls.level_file)
+		yield 0.1
+		for progress in new_level.iter_load():
+			yield 0.1 + progress * 0.7
+		
+		# Upload an image a step, so building the state only hits the cache
+		for i, image in enumerate(images):
+			media_manager.load_texture(image, owner=new_level)
+			yield 0.8 + 0.2 * (i + 1) / len(images)
+		level.loaded_levels[cls.level_file] = new_level
+		yield 1.0
+		
 	def stop(self):
-		# Remove GL display lists from memory
-		for model in self.level_pages.get_models():
-			try:
-				glDeleteLists(model, 1)
-			except:
-				pass
 		GameState.stop(self)
+		# Remove level meshes, textures and data from memory
+		self.level.close()
 		
 	def handle_event(self, event):
 		"""Handle events specific to game state"""
@@ -139,6 +296,7 @@ class Game(GameState):
 				if event.key == K_RETURN or event.type == JOYBUTTONDOWN:
 					self.transition_in = False
 					self.allow_control = True
+					self.preload_next_level()
 					self.camera.stop_transition()
 					self.background_alpha = 1.0
 					self.player_alpha = 1.0
@@ -148,6 +306,11 @@ class Game(GameState):
 			# **Dev stuff
 			if event.key == K_F6:
 				print "Player x, y: ", self.player.x, self.player.y
+			if event.key == K_F7:
+				self.parallax.report()
+				render_queue.report()
+				resources.report()
+				asset_stats.report()
 			if event.key == K_0:
 				cp = '0'
 			if event.key == K_1:
@@ -176,9 +339,10 @@ class Game(GameState):
 				pass
 		return True
 
-	def tick(self, interval):
-		""" Functions called every frame """
-		GameState.tick(self, interval)
+	def update(self, interval):
+		"""Read controls and move everything by one step"""
+		GameState.update(self, interval)
+		self.save_positions()
 		
 		# Handle Key down
 		pressed = pygame.key.get_pressed()
@@ -305,6 +469,7 @@ class Game(GameState):
 				if self.background_alpha == 1.0:
 					self.transition_in = False
 					self.allow_control = True
+					self.preload_next_level()
 		# Transition out
 		if self.transition_out:
 			if self.camera.zoom < 0.5:
@@ -315,27 +480,80 @@ class Game(GameState):
 				if self.background_alpha < 0.0:
 					self.background_alpha = 0.0
 				if self.camera.zoom <= 0.002:
+					# Stopped states don't draw, or pages would be built again
 					self.stop()
-					
-		current_page = self.camera.current_page()
+					return
+		
+	def save_positions(self):
+		"""Save the camera and sprite positions to interpolate from"""
+		interpolator = self.interpolator
+		interpolator.clear()
+		interpolator.save(self.camera, ('x', 'y', 'zoom'))
+		for sprite in self.g_actors.sprites() + self.g_layer2.sprites():
+			interpolator.save(sprite)
+		interpolator.save(self.player.grapplinghook)
+		
+	def draw(self, blend=1.0):
+		"""Draw backgrounds, level and sprites blend of the way through a step"""
+		self.interpolator.begin(blend)
+		cam = self.camera
+		
+		# Draw Backgrounds
+		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
+		self.parallax.draw()
+		
+		# Move view to camera
+		left, right, bottom, top = cam.get_coords(self.level.width, self.level.height)
+		glMatrixMode(GL_PROJECTION)
+		glLoadIdentity()
+		gluOrtho2D(left, right, bottom, top)	
+		
+		# Draw Level
+		self.draw_level(cam)
+		
+		# Draw Sprites
+		self.g_actors.queue(0, self.player_alpha)
+		if self.transition_in:
+			self.g_transition.queue(1, self.transition_alpha)
+		self.g_layer2.queue(2)
+		render_queue.flush()
+				
+		# Zoom Out
+		glMatrixMode(GL_PROJECTION)
+		glLoadIdentity()
+		gluOrtho2D(0.0, self.width, 0.0, self.height)
+		self.interpolator.end()
+		
+	def draw_level(self, cam):
+		self.level_pages.draw(cam)
 	
 	def leave_level(self):
 		self.transition_out = True
 		self.music.fadeout(1000)
 		self.camera.start_transition(into=False)
 		
-	def process_collision_properties(self, properties, sprite):
-		"""Process collisions of sprite"""
-		for property, value in properties.iteritems():
-			if property == "kill":
-				self.kill(sprite)
-			if property == "checkpoint":
-				self.checkpoint = self.spawn_points[str(value)]
-			if property == "goal":
-				if self.goal_reached is False:
-					self.parent.add_game_state(self.next_level(self.parent))
-					self.leave_level()
-					self.goal_reached = True
+	def preload_next_level(self):
+		"""
+		Load the next level's data and music and decode its images in the
+		background, so reaching the goal only has to upload them
+		"""
+		next_level = self.next_level
+		level_file = getattr(next_level, 'level_file', None)
+		if level_file is None:
+			return
+		level.preload_level(level_file, next_level.images(), *next_level.loaders())
+		
+	def process_collision_properties(self, properties, values, sprite):
+		"""Process collisions of sprite, properties are level property flags"""
+		if properties & level.KILL:
+			self.kill(sprite)
+		if properties & level.CHECKPOINT:
+			self.checkpoint = self.spawn_points[str(values['checkpoint'])]
+		if properties & level.GOAL:
+			if self.goal_reached is False:
+				self.parent.add_game_state(self.next_level(self.parent))
+				self.leave_level()
+				self.goal_reached = True
 	
 	def kill(self, sprite):
 		if sprite in self.g_actors:
@@ -347,6 +565,8 @@ class Game(GameState):
 		self.player.x = self.checkpoint.x
 		self.player.y = self.checkpoint.y
 		self.g_actors.add(self.player)
+		# Jump straight there rather than sliding across the level
+		self.interpolator.forget(self.player)
 		
 	def spawn_explosion(self, x, y):
 		particles = []
@@ -359,76 +579,47 @@ class Game(GameState):
 class TestLevel(Game):
 	"""Test Level, NEVER USE!"""
 	
+	level_file = 'level0.svg'
+	backgrounds = (
+		('level2_background_1.png', 1100.0, 0),
+		('level2_background_2.png', 1250.0, 0),
+		('level2_background_3.png', 1650.0, 0),
+	)
+	
 	def __init__(self, parent):
 		# Level
-		self.level = level.Level('level0.svg')
+		self.level = level.get_level(self.level_file)
 		self.current_level = TestLevel
 		self.next_level = TestLevel2
 		
 		# Sprites
 		self.player = StickDude(self)
-		self.background = ImageBackground(0, 0, 1100.0, 1100.0, 'level2_background_1.png')
-		self.background2 = ImageBackground(0, 0, 1250.0, 1250.0, 'level2_background_2.png')
-		self.background3 = ImageBackground(0, 0, 1650.0, 1650.0, 'level2_background_3.png')
 		
 		Game.__init__(self, parent)
 		
 		# **Temporary collision sprites
 		self.level_pages_dev = self.level.load_collision_as_sprites()
-				
-	def tick(self, interval):
-		""" Functions called every frame """
-		Game.tick(self, interval)
-		
-		cam = self.camera
-		
-		# Draw Backgrounds
-		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
-		left, right, bottom, top = cam.get_coords(self.background.width, self.background.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background.draw()
-		left, right, bottom, top = cam.get_coords(self.background2.width, self.background2.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background2.draw()
-		left, right, bottom, top = cam.get_coords(self.background3.width, self.background3.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background3.draw()
-		
-		# Move view to camera
-		left, right, bottom, top = cam.get_coords(self.level.width, self.level.height)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)	
 		
-		# Draw Level
+	def draw_level(self, cam):
 		self.level_pages_dev.draw(cam)
-		self.level_pages.draw(cam)
-		glColor4f(1.0, 1.0, 1.0, self.player_alpha)
-		self.g_actors.draw()
-		if self.transition_in:
-			glColor4f(1.0, 1.0, 1.0, self.transition_alpha)
-			self.g_transition.draw()
-		glColor4f(1.0, 1.0, 1.0, 1.0)
-		self.g_layer2.draw()
-				
-		# Zoom Out
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(0.0, self.width, 0.0, self.height)
+		Game.draw_level(self, cam)
 
 
 class Level1(Game):
 	"""Computer Time"""
 	
+	level_file = 'level1.svg'
+	music_file = 'level1_song.ogg'
+	backgrounds = (
+		('level1_background_1.png', 1000.0, 0),
+		('level1_background_2.png', 1300.0, 1.2),
+		('level1_background_4.png', 1650.0, 2),
+		('level1_background_5.png', 1700.0, 2),
+	)
+	
 	def __init__(self, parent):
 		# Level
-		self.level = level.Level('level1.svg')
+		self.level = level.get_level(self.level_file)
 		self.current_level = Level1
 		self.next_level = Level2
 		
@@ -436,74 +627,28 @@ class Level1(Game):
 		self.player = StickDude(self)
 		self.player.hasjetpack = False
 		self.player.hasgrapple = False
-		self.background = ImageBackground(0, 0, 1000.0, 1000.0, 'level1_background_1.png')
-		self.background2 = ImageBackground(0, 0, 1300.0, 1300.0, 'level1_background_2.png', tile_scale = 1.2)
-		self.background3 = ImageBackground(0, 0, 1650.0, 1650.0, 'level1_background_4.png', tile_scale = 2)
-		self.background4 = ImageBackground(0, 0, 1700.0, 1700.0, 'level1_background_5.png', tile_scale = 2)
 		
 		# Music
-		self.music = media_manager.load_sound('level1_song.ogg')
+		self.music = media_manager.load_sound(self.music_file)
 		self.music.play(-1)
 		
 		Game.__init__(self, parent)
-				
-	def tick(self, interval):
-		""" Functions called every frame """
-		Game.tick(self, interval)
-		
-		cam = self.camera
-		
-		# Draw Backgrounds
-		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
-		left, right, bottom, top = cam.get_coords(self.background.width, self.background.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background.draw()
-		left, right, bottom, top = cam.get_coords(self.background2.width, self.background2.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background2.draw()
-		left, right, bottom, top = cam.get_coords(self.background3.width, self.background3.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background3.draw()
-		left, right, bottom, top = cam.get_coords(self.background4.width, self.background4.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background4.draw()
-		
-		# Move view to camera
-		left, right, bottom, top = cam.get_coords(self.level.width, self.level.height)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)	
-		
-		# Draw Level
-		self.level_pages.draw(cam)
-		glColor4f(1.0, 1.0, 1.0, self.player_alpha)
-		self.g_actors.draw()
-		if self.transition_in:
-			glColor4f(1.0, 1.0, 1.0, self.transition_alpha)
-			self.g_transition.draw()
-		glColor4f(1.0, 1.0, 1.0, 1.0)
-		self.g_layer2.draw()
-				
-		# Zoom Out
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(0.0, self.width, 0.0, self.height)
 		
 		
 class Level2(Game):
 	"""The Machine"""
 	
+	level_file = 'level2.svg'
+	music_file = 'level2_song.ogg'
+	backgrounds = (
+		('level2_background_1.png', 1100.0, 1.0),
+		('level2_background_2.png', 1250.0, 1.0),
+		('level2_background_3.png', 1650.0, 1.0),
+	)
+	
 	def __init__(self, parent):
 		# Level
-		self.level = level.Level('level2.svg')
+		self.level = level.get_level(self.level_file)
 		self.current_level = Level2
 		self.next_level = Level3
 		
@@ -511,68 +656,29 @@ class Level2(Game):
 		self.player = StickDude(self)
 		self.player.hasjetpack = False
 		self.player.hasgrapple = True
-		self.background = ImageBackground(0, 0, 1100.0, 1100.0, 'level2_background_1.png', tile_scale = 1.0)
-		self.background2 = ImageBackground(0, 0, 1250.0, 1250.0, 'level2_background_2.png', tile_scale = 1.0)
-		self.background3 = ImageBackground(0, 0, 1650.0, 1650.0, 'level2_background_3.png', tile_scale = 1.0)
 		
 		# Music
-		self.music = media_manager.load_sound('level2_song.ogg')
+		self.music = media_manager.load_sound(self.music_file)
 		self.music.play(-1)
 		
 		Game.__init__(self, parent)
-				
-	def tick(self, interval):
-		""" Functions called every frame """
-		Game.tick(self, interval)
-		
-		cam = self.camera
-		
-		# Draw Backgrounds
-		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
-		left, right, bottom, top = cam.get_coords(self.background.width, self.background.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background.draw()
-		left, right, bottom, top = cam.get_coords(self.background2.width, self.background2.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background2.draw()
-		left, right, bottom, top = cam.get_coords(self.background3.width, self.background3.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background3.draw()
-		
-		# Move view to camera
-		left, right, bottom, top = cam.get_coords(self.level.width, self.level.height)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)	
-		
-		# Draw Level
-		self.level_pages.draw(cam)
-		glColor4f(1.0, 1.0, 1.0, self.player_alpha)
-		self.g_actors.draw()
-		if self.transition_in:
-			glColor4f(1.0, 1.0, 1.0, self.transition_alpha)
-			self.g_transition.draw()
-		glColor4f(1.0, 1.0, 1.0, 1.0)
-		self.g_layer2.draw()
-				
-		# Zoom Out
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(0.0, self.width, 0.0, self.height)
 		
 		
 class Level3(Game):
 	"""In the toaster"""
 	
+	level_file = 'level3.svg'
+	music_file = 'level3_song.ogg'
+	backgrounds = (
+		('level3_background_1.png', 1100.0, 1.0),
+		('level3_background_2.png', 1250.0, 1.0),
+		('level3_background_3.png', 1650.0, 1.0),
+		('level3_background_4.png', 1660.0, 1.0),
+	)
+	
 	def __init__(self, parent):
 		# Level
-		self.level = level.Level('level3.svg')
+		self.level = level.get_level(self.level_file)
 		self.current_level = Level3
 		self.next_level = ToastWin
 		
@@ -580,66 +686,12 @@ class Level3(Game):
 		self.player = StickDude(self)
 		self.player.hasjetpack = True
 		self.player.hasgrapple = True
-		self.background = ImageBackground(0, 0, 1100.0, 1100.0, 'level3_background_1.png', tile_scale = 1.0)
-		self.background2 = ImageBackground(0, 0, 1250.0, 1250.0, 'level3_background_2.png', tile_scale = 1.0)
-		self.background3 = ImageBackground(0, 0, 1650.0, 1650.0, 'level3_background_3.png', tile_scale = 1.0)
-		self.background4 = ImageBackground(0, 0, 1660.0, 1660.0, 'level3_background_4.png', tile_scale = 1.0)
 		
 		# Music
-		self.music = media_manager.load_sound('level3_song.ogg')
+		self.music = media_manager.load_sound(self.music_file)
 		self.music.play(-1)
 		
 		Game.__init__(self, parent)
-				
-	def tick(self, interval):
-		""" Functions called every frame """
-		Game.tick(self, interval)
-		
-		cam = self.camera
-		
-		# Draw Backgrounds
-		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
-		left, right, bottom, top = cam.get_coords(self.background.width, self.background.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background.draw()
-		left, right, bottom, top = cam.get_coords(self.background2.width, self.background2.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background2.draw()
-		left, right, bottom, top = cam.get_coords(self.background3.width, self.background3.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background3.draw()
-		left, right, bottom, top = cam.get_coords(self.background4.width, self.background4.height, False)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)
-		self.background4.draw()
-		
-		# Move view to camera
-		left, right, bottom, top = cam.get_coords(self.level.width, self.level.height)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(left, right, bottom, top)	
-		
-		# Draw Level
-		self.level_pages.draw(cam)
-		glColor4f(1.0, 1.0, 1.0, self.player_alpha)
-		self.g_actors.draw()
-		if self.transition_in:
-			glColor4f(1.0, 1.0, 1.0, self.transition_alpha)
-			self.g_transition.draw()
-		glColor4f(1.0, 1.0, 1.0, 1.0)
-		self.g_layer2.draw()
-				
-		# Zoom Out
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(0.0, self.width, 0.0, self.height)
 		
 		
 class ToastWin(GameState):
@@ -661,12 +713,14 @@ class ToastWin(GameState):
 		background = ColorBackground(0.0, 0.0, 800.0, 600.0, (255, 255, 255))
 		toast_x = (self.width - 512.0) / 2
 		toast_y = (self.height - 512.0 - 90.0) / 2
-		self.toast = ImageBackground(toast_x, toast_y, 512.0, 512.0, 'toast.png')
-		self.ninjabot1 = ImageBackground(self.width / 2 - 32, self.height / 2 - 64, 64.0, 128.0, 'ninjabot_jumpup_0.png')
+		self.toast = ImageBackground(toast_x, toast_y, 512.0, 512.0, 'toast.png', owner=self)
+		self.ninjabot1 = ImageBackground(self.width / 2 - 32, self.height / 2 - 64, 64.0, 128.0, 
+										 'ninjabot_jumpup_0.png', owner=self)
 		self.ninjabot2 = ImageBackground(self.width / 2 - 256.0, self.height + 100.0, 
-										 512.0, 1024.0, 'ninjabot_splat.png')
-		self.toaster = ImageBackground(toast_x, toast_y, 512.0, 512.0, 'toaster.png')
-		self.toaster_lever = ImageBackground(self.width / 2 - 260.0, 190.0, 64.0, 64.0, 'toaster_lever.png')
+										 512.0, 1024.0, 'ninjabot_splat.png', owner=self)
+		self.toaster = ImageBackground(toast_x, toast_y, 512.0, 512.0, 'toaster.png', owner=self)
+		self.toaster_lever = ImageBackground(self.width / 2 - 260.0, 190.0, 64.0, 64.0, 
+											 'toaster_lever.png', owner=self)
 		
 		# Add sprites to groups
 		self.g_background.add(background)
@@ -701,9 +755,9 @@ class ToastWin(GameState):
 				self.parent.add_game_state(menu.GameMenu(self.parent, self))
 		return True
 				
-	def tick(self, interval):
-		""" Functions called every frame """
-		GameState.tick(self, interval)
+	def update(self, interval):
+		"""Zoom in, then pop the toast"""
+		GameState.update(self, interval)
 		
 		# Transition in
 		if self.transition_in:
@@ -762,6 +816,7 @@ class ToastWin(GameState):
 		if self.transition_out:
 			self.stop()
 					
+	def draw(self, blend=1.0):
 		self.g_background.draw()
 		
 		# Zoom
@@ -775,14 +830,12 @@ class ToastWin(GameState):
 		glLoadIdentity()
 		gluOrtho2D(left, right, bottom, top)
 		
-		glColor4f(1.0, 1.0, 1.0, self.middle_alpha)
-		self.g_middle.draw()
-		glColor4f(1.0, 1.0, 1.0, self.toaster_alpha)
-		self.g_toaster_lever.draw()
-		self.g_toaster.draw()
-		self.g_front.draw()
+		self.g_middle.queue(0, self.middle_alpha)
+		self.g_toaster_lever.queue(1, self.toaster_alpha)
+		self.g_toaster.queue(2, self.toaster_alpha)
+		self.g_front.queue(3, self.toaster_alpha)
+		render_queue.flush()
 		
-		glColor4f(1.0, 1.0, 1.0, 1.0)
 		glMatrixMode(GL_PROJECTION)
 		glLoadIdentity()
 		gluOrtho2D(0.0, self.width, 0.0, self.height)
@@ -791,6 +844,11 @@ class ToastWin(GameState):
 		self.animation_running = False
 		self.transition_out = True
 		
+	def static(self):
+		if self.transition_in or self.animation_running or self.transition_out:
+			return False
+		return True
+		
 
 class Credits(GameState):
 	
@@ -831,7 +889,7 @@ class Credits(GameState):
 									   color=(0, 0, 0), halign='middle'))
 				align_y -= text_height
 			align_y -= text_height
-		self.robot_toast = ImageBackground(-112.0, align_y - 200, 1024.0, 256.0, 'logo.png')
+		self.robot_toast = ImageBackground(-112.0, align_y - 200, 1024.0, 256.0, 'logo.png', owner=self)
 		
 		# Add sprites to groups
 		self.g_background.add(background)
@@ -865,9 +923,9 @@ class Credits(GameState):
 				self.parent.add_game_state(menu.GameMenu(self.parent, self))
 				return True
 				
-	def tick(self, interval):
-		""" Functions called every frame """
-		GameState.tick(self, interval)
+	def update(self, interval):
+		"""Scroll the credits, then fade out to the main menu"""
+		GameState.update(self, interval)
 		
 		# Transition in
 		if self.transition_in:
@@ -908,12 +966,10 @@ class Credits(GameState):
 			if self.timer <= 0:
 				self.stop()
 					
-		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
-		self.g_background.draw()
-		
-		glColor4f(1.0, 1.0, 1.0, self.text_alpha)
-		self.g_text.draw()
-		glColor4f(1.0, 1.0, 1.0, 1.0)
+	def draw(self, blend=1.0):
+		self.g_background.queue(0, self.background_alpha)
+		self.g_text.queue(1, self.text_alpha)
+		render_queue.flush()
 
 		
 	def leave_level(self):
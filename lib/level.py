@@ -22,128 +22,100 @@ along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
 
 from os import path
 import math
+import threading
 from sprites import *
-from model_manager import ModelManage
-from media_manager import MediaManage
+from model_manager import model_manager as model_manage
+from media_manager import media_manager as media_manage
+from resource_manager import resources
+import level_data
+from level_data import SOLID, KILL, NOGRAPPLE, CHECKPOINT, GOAL
 
 
 #------------------------------------------------------------------------------
 #   Globals
 #------------------------------------------------------------------------------
 
-media_manage = MediaManage()
-model_manage = ModelManage()
+# Bytes of page meshes and impostors to keep before deleting the least
+# recently used
+PAGE_BUDGET = 4 * 1024 * 1024
+
+# LevelPreloader threads by level file
+preloaders = {}
+# Levels finished by a loading state, by level file
+loaded_levels = {}
 
 
 #------------------------------------------------------------------------------
 #   Level
 #------------------------------------------------------------------------------
 
-class Tile(BaseEntity):
-	
-	def __init__(self, grid_x, grid_y, tile_size):
-		BaseEntity.__init__(self)
-		# Coordinate location
-		self.x = float(grid_x * tile_size)
-		self.y = float(grid_y * tile_size)
-		self.width = tile_size
-		self.height = tile_size
-		# Location in collision grid
-		self.grid_x = grid_x
-		self.grid_y = grid_y
-		# Properties
-		self.properties = {}
-		
-	def add_property(self, property, value):
-		if property != "":
-			self.properties[property] = value
-				
-	def has_property(self, property):
-		return property in self.properties
-	
-	
 class Level(BaseEntity):
 	
 	def __init__(self, level_file):
+		"""
+		Load level_file
+		
+		Level sprites are left for load_level_sprites or iter_load, and then
+		pages are built as the camera reaches them
+		"""
 		BaseEntity.__init__(self)
 		self.tile_size = 32
 		self.page_size = 512
 		self.name = level_file
-		self.collision_map = None
+		self.sprites_loaded = False
+		# Overdraw of each page before and after culling by (page x, page y)
+		self.page_overdraw = {}
+		# Tiles culled, tiles left, quads after merging and texture ranges
+		# of the pages built, for the report
+		self.culled_count = 0
+		self.tile_count = 0
+		self.quad_count = 0
+		self.range_count = 0
+		# OpacityMaps of the tile images by name, for culling
+		self.opacity = {}
 		
-		self.xml_doc = media_manage.load_xml(level_file)
-		self.layers = self.xml_doc.getElementsByTagName('g')
+		# Compiled level, rebuilt from the SVG when it has changed
+		self.data = level_data.load_level(level_file, self.tile_size, self.page_size)
 		
 		# Get level dimensions
-		for layer in self.layers:
-			if layer.attributes['inkscape:label'].value == "LEVEL_BOUNDS":
-				xml_rect = layer.getElementsByTagName('rect')[0]
-				break
-		self.width = round(float(xml_rect.attributes['width'].value))
-		self.height = round(float(xml_rect.attributes['height'].value))
-		
-		# Load collision map
-		self.collision_map = self.load_collision_map()
-			
-	def load_collision_map(self):
-		#
-		# Collision Map
-		#
+		self.width = float(self.data.width)
+		self.height = float(self.data.height)
 		
-		# Create 2d array
-		collision_map = []
-		for x in range(int(math.ceil(self.width / self.tile_size))):
-			collision_map_y = []
-			for y in range(int(math.ceil(self.height / self.tile_size))):
-				collision_map_y.append(Tile(x, y, self.tile_size))
-			collision_map.append(collision_map_y)
+		# Names of the tile images, every tile record is read to find them
+		self.tile_images = self.data.images()
+		# Images with runs of tiles, these keep their own texture so the runs
+		# can merge into repeating quads
+		self.repeated_images = self.data.repeated_images()
 		
-		collision_rects = []
-		for layer in self.layers:
-			try:
-				if layer.attributes['inkscape:label'].value == "COLLISION":
-					collision_rects.extend(layer.getElementsByTagName('rect'))
-				elif layer.attributes['inkscape:label'].value == "SPECIAL":
-					collision_rects.extend(layer.getElementsByTagName('rect'))
-			except KeyError:
-				pass
+		# Spatial index of collision rects
+		self.collision_map = self.data.collision_map()
 		
-		for rect in collision_rects:
-			# Pixel coordinates
-			width = int(round(float(rect.attributes['width'].value)))
-			height = int(round(float(rect.attributes['height'].value)))
-			x = int(round(float(rect.attributes['x'].value)))
-			y = self.height - int(round(float(rect.attributes['y'].value))) - height
+		self.level_pages = LevelPages(self.data.pages_x, self.data.pages_y, self.page_size,
+									  self.build_page, PAGE_BUDGET)
 			
-			# Ignore out of bounds tiles
-			if x < 0 or x > self.width or y < 0 or y > self.height:
-				#print "Collision rect out of bounds - x: %s, y: %s" % (x, y)
-				continue
+	def start_pages(self):
+		"""Return (x, y) of the pages around the first player start"""
+		start = self.load_entities('PLAYERSTART').get('1')
+		if start is None:
+			return self.level_pages.around(0, 0)
+		return self.level_pages.around(int(start.x / self.page_size), int(start.y / self.page_size))
 			
-			# Collision map coordinates
-			grid_width = width / self.tile_size
-			grid_height = height / self.tile_size
-			grid_x = int(x / self.tile_size)
-			grid_y = int(y / self.tile_size)
-			
-			# rect properties
-			try:
-				property = rect.attributes['property'].value
-				value = rect.attributes['value'].value
-			except:
-				print "Collision rect missing property or value"
-				property = ""
-				value = ""
-				
-			# Add tiles to collision map
-			for tile_x in range(grid_x, grid_x + grid_width):
-				for tile_y in range(grid_y, grid_y + grid_height):
-					try:
-						collision_map[tile_x][tile_y].add_property(property, value)
-					except:
-						print "Error adding to collision map: ", grid_x, grid_y
+	def iter_load(self):
+		"""
+		Build level sprites a step at a time
 		
-		return collision_map
+		Yields progress from 0.0 to 1.0
+		"""
+		steps = float(len(self.start_pages()))
+		for page in self.iter_level_sprites():
+			yield page / steps
+		yield 1.0
+			
+	def close(self):
+		"""Delete the level's pages and textures and unmap its data once it's left"""
+		self.level_pages.delete()
+		resources.release(self)
+		self.data.close()
 	
 	def load_collision_as_sprites(self):
 		#
@@ -152,154 +124,124 @@ class Level(BaseEntity):
 		
 		# Create page grid to assemble display tiles into
 		page_grid = []
-		page_group_data = []
-		for x in range(int(math.ceil(self.width / self.page_size))):
+		for x in range(self.data.pages_x):
 			page_grid_y = []
-			page_group_y = []
-			for y in range(int(math.ceil(self.height / self.page_size))):
+			for y in range(self.data.pages_y):
 				page_grid_y.append([])
-				page_group_y.append(None)
 			page_grid.append(page_grid_y)
-			page_group_data.append(page_group_y)
 		
-		# Iterate through all tiles
-		for layer in self.layers:
-			try:
-				if layer.attributes['inkscape:label'].value == "COLLISION":
-					rect_list = layer.getElementsByTagName('rect')
-					break
-			except KeyError:
-				pass
-			
-		texture = media_manage.load_texture('thistiledoesntexist.png')
+		region = media_manage.texture_region('thistiledoesntexist.png', owner=self)
 		
-		for rect in rect_list:
-			rect_width = int(rect.attributes['width'].value)
-			rect_height = int(rect.attributes['height'].value)
-			rect_x = int(round(float(rect.attributes['x'].value)))
-			rect_y = self.height - int(round(float(rect.attributes['y'].value))) - rect_height
-			
-			# Collision map coordinates
-			grid_width = rect_width / self.tile_size
-			grid_height = rect_height / self.tile_size
-			grid_x = int(rect_x / self.tile_size)
-			grid_y = int(rect_y / self.tile_size)
-			
-			# Add tiles to collision map
-			for tile_x in range(grid_x, grid_x + grid_width):
-				for tile_y in range(grid_y, grid_y + grid_height):
-					x = tile_x * self.tile_size
-					y = tile_y * self.tile_size
-					
-					# Ignore out of bounds tiles
-					if x < 0 or x > self.width or y < 0 or y > self.height:
-						#print "Tile out of bounds - x: %s, y: %s" % (x, y)
-						continue
-					
-					page_grid_x = int(x / self.page_size)
-					page_grid_y = int(y / self.page_size)
-					x -= self.page_size * page_grid_x
-					y -= self.page_size * page_grid_y
-					try:
-						page_grid[page_grid_x][page_grid_y].append((x, y, 32.0, 32.0, texture))
-					except IndexError:
-						#print "Tile outside of page grid - x: %s, y: %s" \
-						#	  % (page_grid_x, page_grid_y)
-						pass
+		# Iterate through all solid rects
+		for rect in self.collision_map.rects:
+			if rect.flags & SOLID:
+				x = rect.left
+				y = rect.bottom
+				page_grid_x = int(x / self.page_size)
+				page_grid_y = int(y / self.page_size)
+				x -= self.page_size * page_grid_x
+				y -= self.page_size * page_grid_y
+				try:
+					page_grid[page_grid_x][page_grid_y].append((x, y, rect.right - rect.left,
+																rect.top - rect.bottom, region))
+				except IndexError:
+					pass
 		
-		# Create level models
-		x = 0
-		for data_x in page_grid:
-			y = 0
-			for tile_data in data_x:
-				model_name = "%s_%s_%s" % (self.name, x, y)
-				gl_model = model_manage.tiled_quads(model_name, tile_data)
-				if gl_model is False:
-					y += 1
-					continue
-				page_x = self.page_size * x
-				page_y = self.page_size * y
-				page_sprite = TilePage(page_x, page_y, self.page_size, self.page_size, gl_model)
-				page_group_data[x][y] = page_sprite
-				y += 1
-			x += 1
+		# Create level models as they're needed
+		def build_page(x, y):
+			model_name = "%s_%s_%s" % (self.name, x, y)
+			gl_model = model_manage.tiled_mesh(model_name, page_grid[x][y], owner=self)
+			if gl_model is False:
+				return None
+			return TilePage(self.page_size * x, self.page_size * y, 
+							self.page_size, self.page_size, gl_model)
 		
-		level_pages = LevelPages(page_group_data)
+		level_pages = LevelPages(self.data.pages_x, self.data.pages_y, self.page_size,
+								 build_page, PAGE_BUDGET)
 		return level_pages
 	
 	def load_level_sprites(self):
-		#
-		# Level Model
-		#
+		if not self.sprites_loaded:
+			for page in self.iter_level_sprites():
+				pass
+		return self.level_pages
+	
+	def iter_level_sprites(self):
+		"""
+		Get tile textures ready and build the pages around the player start,
+		yield after each page
+		"""
+		# Decode every tile image up front, uploads happen page by page
+		sub_dir = 'levels'
+		images = self.tile_images
+		decoding = media_manage.decode_images(images, sub_dir)
+		while not decoding.ready():
+			decoding.wait(0.002)
+			yield 0
+		self.opacity = media_manage.opacity_maps(images, sub_dir)
 		
-		# Create page grid to assemble display tiles into
-		page_grid = []
-		page_group_data = []
-		for x in range(int(math.ceil(self.width / self.page_size))):
-			page_grid_y = []
-			page_group_y = []
-			for y in range(int(math.ceil(self.height / self.page_size))):
-				page_grid_y.append([])
-				page_group_y.append(None)
-			page_grid.append(page_grid_y)
-			page_group_data.append(page_group_y)
+		# Pack the small tiles into a few atlas textures, leaving out those
+		# that repeat, as atlas regions can't
+		for atlas_count in media_manage.iter_build_atlas(self.name, images - self.repeated_images,
+														 sub_dir, owner=self):
+			yield 0
 		
-		# Iterate through all tiles
-		for layer in self.layers:
-			try:
-				if layer.attributes['inkscape:label'].value == "TILE1":
-					tile_list = layer.getElementsByTagName('image')
-					break
-			except KeyError:
-				pass
+		page = 0
+		for x, y in self.start_pages():
+			self.level_pages.page(x, y)
+			page += 1
+			yield page
+		self.sprites_loaded = True
 		
-		for tile in tile_list:
-			imageparts = tile.attributes['xlink:href'].value.split('\\')
-			image = ''
-			for part in imageparts:
-				image = path.join(image, part)
-			sub_dir = 'levels'
-			texture = media_manage.load_texture(image, sub_dir=sub_dir)
-			
-			width = int(tile.attributes['width'].value)
-			height = int(tile.attributes['height'].value)
-			x = int(round(float(tile.attributes['x'].value)))
-			y = self.height - int(round(float(tile.attributes['y'].value))) - height
-			
-			# Ignore out of bounds tiles
-			if x < 0 or x > self.width or y < 0 or y > self.height:
-				#print "Tile out of bounds - x: %s, y: %s" % (x, y)
-				continue
-	
-			page_grid_x = int(x / self.page_size)
-			page_grid_y = int(y / self.page_size)
-			x -= self.page_size * page_grid_x
-			y -= self.page_size * page_grid_y
-			try:
-				page_grid[page_grid_x][page_grid_y].append((x, y, width, height, texture))
-			except IndexError:
-				#print "Tile outside of page grid - x: %s, y: %s" \
-				#	  % (page_grid_x, page_grid_y)
-				pass
+		# Atlases may have been built by an earlier load of the level
+		regions = [media_manage.regions.get(media_manage.asset_path(image, sub_dir)) 
+				   for image in images]
+		regions = [region for region in regions if region is not None]
+		print "%s: %d tile images packed into %d atlas textures, %d left out to repeat" % \
+			  (self.name, len(regions), len(set([region[0] for region in regions])), 
+			   len(self.repeated_images))
+		print "%s: %d of %d pages built up front" % \
+			  (self.name, page, self.data.pages_x * self.data.pages_y)
+		print "%s: %d tiles merged into %d quads, %d quads and %d texture binds saved" % \
+			  (self.name, self.tile_count, self.quad_count, self.tile_count - self.quad_count,
+			   self.tile_count - self.range_count)
+		if self.page_overdraw:
+			before = [overdraw[0] for overdraw in self.page_overdraw.values()]
+			after = [overdraw[1] for overdraw in self.page_overdraw.values()]
+			print "%s: %d hidden tiles culled, page overdraw %.2f average, %.2f worst before, %.2f, %.2f after" % \
+				  (self.name, self.culled_count, sum(before) / len(before), max(before), 
+				   sum(after) / len(after), max(after))
+				   
+	def build_page(self, x, y):
+		"""Return TilePage of page x, y or None if it's empty"""
+		# Drop tiles hidden behind opaque ones
+		tiles = self.data.page_tiles(x, y)
+		visible = model_manage.cull_tiles(tiles, self.opacity)
+		self.culled_count += len(tiles) - len(visible)
+		if tiles:
+			self.page_overdraw[(x, y)] = (
+				model_manage.overdraw(tiles, self.page_size, self.page_size),
+				model_manage.overdraw(visible, self.page_size, self.page_size))
 		
-		# Create level models
-		x = 0
-		for data_x in page_grid:
-			y = 0
-			for tile_data in data_x:
-				model_name = "%s_%s_%s" % (self.name, x, y)
-				gl_model = model_manage.tiled_quads(model_name, tile_data)
-				if gl_model is False:
-					y += 1
-					continue
-				page_x = self.page_size * x
-				page_y = self.page_size * y
-				page_sprite = TilePage(page_x, page_y, self.page_size, self.page_size, gl_model)
-				page_group_data[x][y] = page_sprite
-				y += 1
-			x += 1
-		level_pages = LevelPages(page_group_data)
-		return level_pages
+		# Swap image names for texture regions
+		tile_data = []
+		for tile_x, tile_y, width, height, image in visible:
+			region = media_manage.texture_region(image, 'levels', owner=self)
+			tile_data.append((tile_x, tile_y, width, height, region))
+		
+		# Merge runs of the same tile
+		quads = model_manage.merge_tiles(tile_data)
+		self.tile_count += len(tile_data)
+		self.quad_count += len(quads)
+		self.range_count += len(model_manage.group_tiles(quads))
+		
+		# Create level model
+		model_name = "%s_%s_%s" % (self.name, x, y)
+		gl_model = model_manage.tiled_mesh(model_name, quads, owner=self)
+		if gl_model is False:
+			return None
+		return TilePage(self.page_size * x, self.page_size * y, 
+						self.page_size, self.page_size, gl_model)
 	
 	def load_entities(self, entity_name):
 		#
@@ -308,61 +250,140 @@ class Level(BaseEntity):
 		
 		entity_objects = {"PLAYERSTART": PlayerStart}
 		
-		for layer in self.layers:
-			try:
-				if layer.attributes['inkscape:label'].value == "SPRITES":
-					entity_elements = layer.getElementsByTagName('image')
-					break
-			except:
-				pass
-		
 		entities = {}
-		for entity in entity_elements:
-			try:
-				name = entity.attributes['name'].value
-				value = entity.attributes['value'].value
-			except:
-				print "Entity load failure: element missing attribute"
-				continue
+		for name, value, x, y in self.data.entities():
 			if name == entity_name:
-				width = int(entity.attributes['width'].value)
-				height = int(entity.attributes['height'].value)
-				x = int(round(float(entity.attributes['x'].value)))
-				y = self.height - int(round(float(entity.attributes['y'].value))) - height
-				
-				# Ignore out of bounds tiles
-				if x < 0 or x > self.width or y < 0 or y > self.height:
-					print "Entity out of bounds - x: %s, y: %s" % (x, y)
-					continue
-				
 				entities[value] = entity_objects[name](x, y, value)
 		
 		return entities
 			
-			
 	def point_collide(self, x, y):
-		tile_size = self.tile_size
-		grid_x = int(x / tile_size)
-		grid_y = int(y / tile_size)
-		try:
-			return self.collision_map[grid_x][grid_y]
-		except IndexError:
-			return False
+		"""Return property flags of the collision rects at x, y"""
+		return self.collision_map.point(x, y)
 		
 	def tile_collide(self, sprite):
-		tile_size = self.tile_size
-		tiles = []
-		properties = []
-		grid_x1 = int(sprite.left / tile_size)
-		grid_x2 = int((sprite.right - 0.0001) / tile_size)
-		grid_y1 = int(sprite.bottom / tile_size)
-		grid_y2 = int((sprite.top - 0.0001) / tile_size)
-		for x in range(grid_x1, grid_x2 + 1):
-			for y in range(grid_y1, grid_y2 + 1):
-				try:
-					tile = self.collision_map[x][y]
-				except IndexError:
-					pass
-				else:
-					tiles.append(tile)
-		return tiles
+		"""Return collision rects overlapping sprite"""
+		return self.collision_map.query(sprite.left, sprite.bottom, sprite.right, sprite.top)
+		
+	def collide(self, sprite, vx=0.0, vy=0.0):
+		"""Return (push_x, push_y, flags, value) of the collision rects overlapping sprite"""
+		return self.collision_map.collide(sprite.left, sprite.bottom, sprite.right, sprite.top, 
+										  vx, vy)
+		
+	def sweep_x(self, sprite, dx):
+		"""Return how far sprite can move dx before reaching into a solid rect"""
+		return self.collision_map.sweep_x(sprite.left, sprite.bottom, sprite.right, sprite.top, dx)
+		
+	def sweep_y(self, sprite, dy):
+		"""Return how far sprite can move dy before reaching into a solid rect"""
+		return self.collision_map.sweep_y(sprite.left, sprite.bottom, sprite.right, sprite.top, dy)
+
+
+#------------------------------------------------------------------------------
+#   Preloading
+#------------------------------------------------------------------------------
+
+class LevelPreloader(threading.Thread):
+	"""
+	Build a Level and decode its tile images and images in the background
+	
+	Nothing here touches GL, textures are uploaded by load_level_sprites
+	on the main thread. Extra loaders (music etc.) are called afterwards.
+	A cancelled preloader skips what's left and throws away the level and
+	what it decoded once it's done.
+	"""
+	
+	def __init__(self, level_file, images, *loaders):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.level_file = level_file
+		self.images = images
+		self.loaders = loaders
+		self.level = None
+		self.tile_images = ()
+		self.lock = threading.Lock()
+		self.cancelled = False
+		self.finished = False
+		
+	def run(self):
+		try:
+			level = Level(self.level_file)
+			self.tile_images = level.tile_images
+			steps = [lambda: media_manage.decode_images(level.tile_images, sub_dir='levels').wait(),
+					 lambda: media_manage.decode_images(self.images).wait()]
+			for step in steps + list(self.loaders):
+				if self.cancelled:
+					break
+				step()
+			self.level = level
+		except (Exception, SystemExit), e:
+			print "Preloading %s failed: %s" % (self.level_file, e)
+		self.lock.acquire()
+		try:
+			self.finished = True
+			if self.cancelled:
+				self.discard()
+		finally:
+			self.lock.release()
+			
+	def cancel(self):
+		"""Stop preloading, the level won't be played"""
+		self.lock.acquire()
+		try:
+			self.cancelled = True
+			if self.finished:
+				self.discard()
+		finally:
+			self.lock.release()
+			
+	def discard(self):
+		"""Unmap the level and forget the images decoded for it"""
+		media_manage.forget_decoded(self.tile_images, 'levels')
+		media_manage.forget_decoded(self.images)
+		if self.level is not None:
+			self.level.data.close()
+			self.level = None
+
+
+def preload_level(level_file, images, *loaders):
+	"""Start preloading a level and images unless it's already on its way"""
+	if level_file not in preloaders:
+		preloader = LevelPreloader(level_file, images, *loaders)
+		preloaders[level_file] = preloader
+		preloader.start()
+		
+def drop_preloads():
+	"""
+	Cancel level preloaders and close levels loaded but not played, once
+	play is left for the menu
+	"""
+	for preloader in preloaders.values():
+		preloader.cancel()
+	preloaders.clear()
+	for level in loaded_levels.values():
+		level.close()
+	loaded_levels.clear()
+	
+def wait_for_level(level_file, timeout):
+	"""
+	Wait up to timeout seconds for a level being preloaded, return True
+	once get_level won't have to wait
+	"""
+	preloader = preloaders.get(level_file)
+	if preloader is None:
+		return True
+	preloader.join(timeout)
+	return not preloader.isAlive()
+	
+def get_level(level_file):
+	"""Return the loaded or preloaded Level, waiting for it if needed, or build one"""
+	try:
+		return loaded_levels.pop(level_file)
+	except KeyError:
+		pass
+	preloader = preloaders.pop(level_file, None)
+	if preloader is not None:
+		preloader.join()
+		if preloader.level is not None:
+			return preloader.level
+	return Level(level_file)
@@ -0,0 +1,697 @@
+"""
+Copyright 2008 Ryan Hoffman
+
+This file is part of Robot Toast.
+
+Robot Toast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Robot Toast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
+"""
+#------------------------------------------------------------------------------
+#   Imports
+#------------------------------------------------------------------------------
+
+import os
+from os import path
+import math
+import mmap
+import struct
+import hashlib
+from xml.etree import cElementTree
+
+
+#------------------------------------------------------------------------------
+#   Globals
+#------------------------------------------------------------------------------
+
+LEVEL_MAGIC = 'RTLV'
+LEVEL_VERSION = 5
+LEVEL_DIR = path.join('data', 'levels')
+
+# Collision property flags
+SOLID = 1
+KILL = 2
+NOGRAPPLE = 4
+CHECKPOINT = 8
+GOAL = 16
+PROPERTY_FLAGS = {'solid': SOLID, 'kill': KILL, 'nograpple': NOGRAPPLE,
+				  'checkpoint': CHECKPOINT, 'goal': GOAL}
+
+# Collision index chunks are CHUNK_SIZE x CHUNK_SIZE cells
+CHUNK_SHIFT = 4
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+
+# magic, version, svg digest, tile size, page size, width, height,
+# grid width, grid height, pages x, pages y, string count, rect count,
+# tile count, entity count, then section offsets for rects, page table, tiles
+# and entities
+HEADER = struct.Struct('<4sH16sHHIIIIIIIIIIIIII')
+STRING_LENGTH = struct.Struct('<H')
+# x, y, width, height, property flags, value
+RECT = struct.Struct('<ffffHH')
+PAGE_INDEX = struct.Struct('<I')
+TILE = struct.Struct('<hhHHH')
+ENTITY = struct.Struct('<HHii')
+
+# Expanded SVG names
+SVG_G = '{http://www.w3.org/2000/svg}g'
+SVG_RECT = '{http://www.w3.org/2000/svg}rect'
+SVG_IMAGE = '{http://www.w3.org/2000/svg}image'
+INKSCAPE_LABEL = '{http://www.inkscape.org/namespaces/inkscape}label'
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+
+#------------------------------------------------------------------------------
+#   Level Data
+#------------------------------------------------------------------------------
+
+class CollisionRect(object):
+	"""Collision rect with the property flags and value it was drawn with"""
+	
+	__slots__ = ('left', 'bottom', 'right', 'top', 'flags', 'value')
+	
+	def __init__(self, x, y, width, height, flags, value):
+		self.left = x
+		self.bottom = y
+		self.right = x + width
+		self.top = y + height
+		self.flags = flags
+		self.value = value
+		
+		
+class CollisionMap(object):
+	"""
+	Static spatial index of collision rects
+	
+	The level is divided into cells of cell_size, each holding a tuple of the
+	rects that overlap it. Cells are stored in chunks of CHUNK_SIZE x
+	CHUNK_SIZE, chunks with nothing in them aren't stored at all.
+	"""
+	
+	def __init__(self, cell_size, grid_w, grid_h):
+		self.cell_size = cell_size
+		self.grid_w = grid_w
+		self.grid_h = grid_h
+		self.chunks_h = (grid_h + CHUNK_MASK) >> CHUNK_SHIFT
+		self.rects = []
+		# Lists of cells by chunk_x * chunks_h + chunk_y
+		self.chunks = {}
+		
+	def add(self, rect):
+		"""Index a CollisionRect"""
+		self.rects.append(rect)
+		cell_size = self.cell_size
+		grid_x1 = max(int(rect.left // cell_size), 0)
+		grid_x2 = min(int(math.ceil(rect.right / cell_size)), self.grid_w)
+		grid_y1 = max(int(rect.bottom // cell_size), 0)
+		grid_y2 = min(int(math.ceil(rect.top / cell_size)), self.grid_h)
+		for grid_x in range(grid_x1, grid_x2):
+			for grid_y in range(grid_y1, grid_y2):
+				key = (grid_x >> CHUNK_SHIFT) * self.chunks_h + (grid_y >> CHUNK_SHIFT)
+				try:
+					chunk = self.chunks[key]
+				except KeyError:
+					chunk = self.chunks[key] = [()] * (CHUNK_SIZE * CHUNK_SIZE)
+				chunk[(grid_x & CHUNK_MASK) << CHUNK_SHIFT | grid_y & CHUNK_MASK] += (rect,)
+		
+	def cell(self, grid_x, grid_y):
+		"""Return rects overlapping cell (grid_x, grid_y)"""
+		if 0 <= grid_x < self.grid_w and 0 <= grid_y < self.grid_h:
+			chunk = self.chunks.get((grid_x >> CHUNK_SHIFT) * self.chunks_h + (grid_y >> CHUNK_SHIFT))
+			if chunk is not None:
+				return chunk[(grid_x & CHUNK_MASK) << CHUNK_SHIFT | grid_y & CHUNK_MASK]
+		return ()
+		
+	def point(self, x, y):
+		"""Return combined flags of the rects containing x, y"""
+		flags = 0
+		for rect in self.cell(int(x // self.cell_size), int(y // self.cell_size)):
+			if rect.left <= x < rect.right and rect.bottom <= y < rect.top:
+				flags |= rect.flags
+		return flags
+		
+	def query(self, left, bottom, right, top):
+		"""Return rects overlapping the given box"""
+		cell_size = self.cell_size
+		grid_x1 = max(int(left // cell_size), 0)
+		grid_x2 = min(int(right // cell_size), self.grid_w - 1)
+		grid_y1 = max(int(bottom // cell_size), 0)
+		grid_y2 = min(int(top // cell_size), self.grid_h - 1)
+		chunks = self.chunks
+		chunks_h = self.chunks_h
+		rects = []
+		for grid_x in range(grid_x1, grid_x2 + 1):
+			chunk_key = (grid_x >> CHUNK_SHIFT) * chunks_h
+			cell_offset = (grid_x & CHUNK_MASK) << CHUNK_SHIFT
+			for grid_y in range(grid_y1, grid_y2 + 1):
+				chunk = chunks.get(chunk_key + (grid_y >> CHUNK_SHIFT))
+				if chunk is None:
+					continue
+				for rect in chunk[cell_offset | grid_y & CHUNK_MASK]:
+					if rect.left < right and rect.right > left and \
+					   rect.bottom < top and rect.top > bottom and rect not in rects:
+						rects.append(rect)
+		return rects
+		
+	def collide(self, left, bottom, right, top, vx, vy):
+		"""
+		Return (push_x, push_y, flags, value) of the rects overlapping a box
+		
+		Solid rects push the box back out against vx and vy, the furthest
+		push on each axis wins. flags are combined from every rect, value is
+		a checkpoint rect's value or None. Cells are walked once without
+		building lists, a rect in several cells is simply seen again
+		"""
+		# Comparisons rather than min() and max(), this runs for every actor
+		# every step
+		cell_size = self.cell_size
+		grid_x1 = int(left // cell_size)
+		if grid_x1 < 0:
+			grid_x1 = 0
+		grid_x2 = int(right // cell_size)
+		if grid_x2 >= self.grid_w:
+			grid_x2 = self.grid_w - 1
+		grid_y1 = int(bottom // cell_size)
+		if grid_y1 < 0:
+			grid_y1 = 0
+		grid_y2 = int(top // cell_size)
+		if grid_y2 >= self.grid_h:
+			grid_y2 = self.grid_h - 1
+		chunks = self.chunks
+		chunks_h = self.chunks_h
+		push_x = 0.0
+		push_y = 0.0
+		flags = 0
+		value = None
+		grid_x = grid_x1
+		while grid_x <= grid_x2:
+			chunk_key = (grid_x >> CHUNK_SHIFT) * chunks_h
+			cell_offset = (grid_x & CHUNK_MASK) << CHUNK_SHIFT
+			grid_y = grid_y1
+			while grid_y <= grid_y2:
+				chunk = chunks.get(chunk_key + (grid_y >> CHUNK_SHIFT))
+				if chunk is None:
+					# Skip the rest of the empty chunk
+					grid_y = (grid_y | CHUNK_MASK) + 1
+					continue
+				for rect in chunk[cell_offset | grid_y & CHUNK_MASK]:
+					if rect.left < right and rect.right > left and \
+					   rect.bottom < top and rect.top > bottom:
+						rect_flags = rect.flags
+						flags |= rect_flags
+						if rect_flags & CHECKPOINT:
+							value = rect.value
+						if rect_flags & SOLID:
+							if vx > 0:
+								push = rect.left - right - 0.0001
+								if push < push_x:
+									push_x = push
+							elif vx < 0:
+								push = rect.right - left
+								if push > push_x:
+									push_x = push
+							if vy < 0:
+								push = rect.top - bottom
+								if push > push_y:
+									push_y = push
+							elif vy > 0:
+								push = rect.bottom - top - 0.0001
+								if push < push_y:
+									push_y = push
+				grid_y += 1
+			grid_x += 1
+		return push_x, push_y, flags, value
+		
+	def sweep_x(self, left, bottom, right, top, dx):
+		"""
+		Return dx cut short at the first solid rect in the box's way
+		
+		Columns of cells are walked from the box's leading edge along dx, so
+		a rect thinner than dx can't be jumped. The box is stopped with its
+		leading edge at the rect's far side, still overlapping it, to be
+		pushed out as if the step had been small. Rects the box already
+		overlaps don't stop it
+		"""
+		if dx == 0:
+			return dx
+		cell_size = self.cell_size
+		grid_y1 = int(bottom // cell_size)
+		grid_y2 = int(top // cell_size)
+		if dx > 0:
+			grid_x = int(right // cell_size)
+			end = int((right + dx) // cell_size) + 1
+			step = 1
+		else:
+			grid_x = int(left // cell_size)
+			end = int((left + dx) // cell_size) - 1
+			step = -1
+		while grid_x != end:
+			stop = None
+			grid_y = grid_y1
+			while grid_y <= grid_y2:
+				for rect in self.cell(grid_x, grid_y):
+					if not rect.flags & SOLID or rect.bottom >= top or rect.top <= bottom:
+						continue
+					if dx > 0:
+						if right <= rect.left < right + dx and (stop is None or rect.right < stop):
+							stop = rect.right
+					elif left + dx < rect.right <= left and (stop is None or rect.left > stop):
+						stop = rect.left
+				grid_y += 1
+			if stop is not None:
+				if dx > 0:
+					return min(dx, stop - right)
+				return max(dx, stop - left)
+			grid_x += step
+		return dx
+		
+	def sweep_y(self, left, bottom, right, top, dy):
+		"""Return dy cut short at the first solid rect in the box's way, like sweep_x"""
+		if dy == 0:
+			return dy
+		cell_size = self.cell_size
+		grid_x1 = int(left // cell_size)
+		grid_x2 = int(right // cell_size)
+		if dy > 0:
+			grid_y = int(top // cell_size)
+			end = int((top + dy) // cell_size) + 1
+			step = 1
+		else:
+			grid_y = int(bottom // cell_size)
+			end = int((bottom + dy) // cell_size) - 1
+			step = -1
+		while grid_y != end:
+			stop = None
+			grid_x = grid_x1
+			while grid_x <= grid_x2:
+				for rect in self.cell(grid_x, grid_y):
+					if not rect.flags & SOLID or rect.left >= right or rect.right <= left:
+						continue
+					if dy > 0:
+						if top <= rect.bottom < top + dy and (stop is None or rect.top < stop):
+							stop = rect.top
+					elif bottom + dy < rect.top <= bottom and (stop is None or rect.bottom > stop):
+						stop = rect.bottom
+				grid_x += 1
+			if stop is not None:
+				if dy > 0:
+					return min(dy, stop - top)
+				return max(dy, stop - bottom)
+			grid_y += step
+		return dy
+	
+
+def compiled_name(level_file):
+	"""Return path of the compiled file for an SVG level"""
+	return path.join(LEVEL_DIR, path.splitext(level_file)[0] + '.lvl')
+
+def svg_digest(level_file):
+	"""Return md5 digest of the level source"""
+	svg = open(path.join(LEVEL_DIR, level_file), 'rb')
+	try:
+		return hashlib.md5(svg.read()).digest()
+	finally:
+		svg.close()
+
+class LevelSource(object):
+	"""
+	Parser target for Inkscape SVG levels
+
+	Elements are routed by the layer they are drawn in and kept as tuples,
+	coordinates are still in SVG space (y down)
+	"""
+
+	# Layers where only the first one in the file is used
+	first_only = ("LEVEL_BOUNDS", "TILE1", "SPRITES")
+	routed = ("LEVEL_BOUNDS", "COLLISION", "SPECIAL", "TILE1", "SPRITES")
+
+	def __init__(self):
+		# (x, y, width, height)
+		self.bounds = None
+		# [(x, y, width, height, property, value), ...]
+		self.collision = []
+		# [(image, x, y, width, height), ...]
+		self.tiles = []
+		# [(name, value, x, y, height), ...]
+		self.entities = []
+		# Route of each open <g>
+		self.layers = [None]
+		self.layers_done = set()
+
+	def start(self, tag, attrib):
+		route = self.layers[-1]
+		if tag == SVG_G:
+			label = attrib.get(INKSCAPE_LABEL)
+			if label in self.routed and label not in self.layers_done:
+				route = label
+			self.layers.append(route)
+		elif route is None:
+			return
+		elif tag == SVG_RECT:
+			if route == "LEVEL_BOUNDS":
+				if self.bounds is None:
+					self.bounds = (float(attrib['x']), float(attrib['y']),
+								   float(attrib['width']), float(attrib['height']))
+			elif route != "TILE1" and route != "SPRITES":
+				try:
+					property = attrib['property']
+					value = attrib['value']
+				except KeyError:
+					print "Collision rect missing property or value"
+					return
+				self.collision.append((float(attrib['x']), float(attrib['y']),
+									   float(attrib['width']), float(attrib['height']),
+									   property, value))
+		elif tag == SVG_IMAGE:
+			if route == "TILE1":
+				self.tiles.append((attrib[XLINK_HREF], float(attrib['x']), float(attrib['y']),
+								   int(attrib['width']), int(attrib['height'])))
+			elif route == "SPRITES":
+				try:
+					name = attrib['name']
+					value = attrib['value']
+				except KeyError:
+					print "Entity load failure: element missing attribute"
+					return
+				self.entities.append((name, value, float(attrib['x']), float(attrib['y']),
+									  int(attrib['height'])))
+
+	def end(self, tag):
+		if tag == SVG_G:
+			route = self.layers.pop()
+			if route in self.first_only and self.layers[-1] != route:
+				self.layers_done.add(route)
+
+	def data(self, data):
+		pass
+
+	def close(self):
+		return self
+
+
+def parse_level(level_file):
+	"""Stream an SVG level through LevelSource in a single pass"""
+	fqpn = path.join(LEVEL_DIR, level_file)
+	try:
+		svg = open(fqpn, 'rb')
+		try:
+			parser = cElementTree.XMLParser(target=LevelSource())
+			while True:
+				chunk = svg.read(65536)
+				if not chunk:
+					break
+				parser.feed(chunk)
+			return parser.close()
+		finally:
+			svg.close()
+	except (IOError, SyntaxError, KeyError, ValueError):
+		print "Error occurred loading %s from %s" % \
+			  (level_file, fqpn)
+		raise SystemExit
+
+def compile_level(level_file, tile_size, page_size):
+	"""
+	Compile an Inkscape SVG level into the binary level format
+
+	Return the compiled data as a string
+	"""
+	digest = svg_digest(level_file)
+	source = parse_level(level_file)
+
+	# Level dimensions
+	width = int(round(source.bounds[2]))
+	height = int(round(source.bounds[3]))
+	grid_w = int(math.ceil(float(width) / tile_size))
+	grid_h = int(math.ceil(float(height) / tile_size))
+	pages_x = int(math.ceil(float(width) / page_size))
+	pages_y = int(math.ceil(float(height) / page_size))
+
+	strings = []
+	string_ids = {}
+	def string_id(string):
+		try:
+			return string_ids[string]
+		except KeyError:
+			string_ids[string] = len(strings)
+			strings.append(string)
+			return string_ids[string]
+
+	#
+	# Collision Map
+	#
+
+	# Rect edges are snapped to whole pixels, so rects drawn a little off
+	# still line up, flipped to y up
+	rects = []
+	for x, y, rect_width, rect_height, property, value in source.collision:
+		left = int(round(x))
+		right = int(round(x + rect_width))
+		bottom = height - int(round(y + rect_height))
+		top = height - int(round(y))
+
+		# Ignore out of bounds and empty rects
+		if left < 0 or left > width or bottom < 0 or bottom > height:
+			continue
+		if right <= left or top <= bottom or property == "":
+			continue
+		try:
+			flags = PROPERTY_FLAGS[property]
+		except KeyError:
+			print "Unknown collision property: %s" % property
+			continue
+		rects.append((left, bottom, right - left, top - bottom, flags, string_id(value)))
+
+	#
+	# Level Tiles
+	#
+
+	pages = [[] for i in range(pages_x * pages_y)]
+	for href, x, y, tile_width, tile_height in source.tiles:
+		image = ''
+		for part in href.split('\\'):
+			image = path.join(image, part)
+		x = int(round(x))
+		y = height - int(round(y)) - tile_height
+
+		# Ignore out of bounds tiles
+		if x < 0 or x > width or y < 0 or y > height:
+			continue
+
+		page_x = x / page_size
+		page_y = y / page_size
+		if page_x >= pages_x or page_y >= pages_y:
+			continue
+		pages[page_x * pages_y + page_y].append(
+			(x - page_x * page_size, y - page_y * page_size,
+			 tile_width, tile_height, string_id(image)))
+
+	#
+	# Sprites and Entities
+	#
+
+	entities = []
+	for name, value, x, y, entity_height in source.entities:
+		x = int(round(x))
+		y = height - int(round(y)) - entity_height
+
+		# Ignore out of bounds entities
+		if x < 0 or x > width or y < 0 or y > height:
+			print "Entity out of bounds - x: %s, y: %s" % (x, y)
+			continue
+		entities.append((string_id(name), string_id(value), x, y))
+	source = None
+
+	#
+	# Pack sections
+	#
+
+	sections = []
+	for string in strings:
+		string = string.encode('utf-8')
+		sections.append(STRING_LENGTH.pack(len(string)))
+		sections.append(string)
+	tables = ''.join(sections)
+
+	rects_offset = HEADER.size + len(tables)
+	page_table_offset = rects_offset + len(rects) * RECT.size
+	tiles_offset = page_table_offset + (len(pages) + 1) * PAGE_INDEX.size
+	tile_count = sum([len(page) for page in pages])
+	entities_offset = tiles_offset + tile_count * TILE.size
+
+	sections = [HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, digest, tile_size,
+							page_size, width, height, grid_w, grid_h, pages_x,
+							pages_y, len(strings), len(rects), tile_count,
+							len(entities), rects_offset, page_table_offset,
+							tiles_offset, entities_offset),
+				tables]
+	sections.extend([RECT.pack(*rect) for rect in rects])
+	start = 0
+	for page in pages:
+		sections.append(PAGE_INDEX.pack(start))
+		start += len(page)
+	sections.append(PAGE_INDEX.pack(start))
+	for page in pages:
+		sections.extend([TILE.pack(*tile) for tile in page])
+	sections.extend([ENTITY.pack(*entity) for entity in entities])
+	return ''.join(sections)
+
+
+class LevelData(object):
+	"""Read access to a compiled level held in a string or memory map"""
+
+	def __init__(self, buffer, source=None):
+		self.buffer = buffer
+		self.source = source
+		(magic, self.version, self.digest, self.tile_size, self.page_size,
+		 self.width, self.height, self.grid_w, self.grid_h, self.pages_x,
+		 self.pages_y, string_count, self.rect_count, self.tile_count,
+		 self.entity_count, self.rects_offset, self.page_table_offset,
+		 self.tiles_offset, self.entities_offset) = HEADER.unpack_from(buffer, 0)
+		if magic != LEVEL_MAGIC:
+			raise ValueError("Not a compiled level")
+		if self.version != LEVEL_VERSION:
+			raise ValueError("Compiled level version %s is out of date" % self.version)
+
+		# String table is small, decode it up front
+		offset = HEADER.size
+		self.strings = []
+		for i in range(string_count):
+			length = STRING_LENGTH.unpack_from(buffer, offset)[0]
+			offset += STRING_LENGTH.size
+			self.strings.append(buffer[offset:offset + length].decode('utf-8'))
+			offset += length
+
+	def collision_map(self):
+		"""Return a CollisionMap of the level's collision rects"""
+		collision_map = CollisionMap(self.tile_size, self.grid_w, self.grid_h)
+		strings = self.strings
+		for i in range(self.rect_count):
+			x, y, width, height, flags, value = RECT.unpack_from(self.buffer, self.rects_offset + i * RECT.size)
+			collision_map.add(CollisionRect(x, y, width, height, flags, strings[value]))
+		return collision_map
+
+	def page_tiles(self, page_x, page_y):
+		"""Return [(x, y, width, height, image), ...] for a page"""
+		buffer = self.buffer
+		index = self.page_table_offset + (page_x * self.pages_y + page_y) * PAGE_INDEX.size
+		start = PAGE_INDEX.unpack_from(buffer, index)[0]
+		stop = PAGE_INDEX.unpack_from(buffer, index + PAGE_INDEX.size)[0]
+		strings = self.strings
+		tiles = []
+		for offset in range(self.tiles_offset + start * TILE.size,
+							self.tiles_offset + stop * TILE.size, TILE.size):
+			x, y, width, height, image = TILE.unpack_from(buffer, offset)
+			tiles.append((x, y, width, height, strings[image]))
+		return tiles
+
+	def images(self):
+		"""Return every image name used by level tiles"""
+		images = set()
+		strings = self.strings
+		for offset in range(self.tiles_offset, self.entities_offset, TILE.size):
+			images.add(strings[TILE.unpack_from(self.buffer, offset)[4]])
+		return images
+
+	def repeated_images(self):
+		"""
+		Return names of images with a tile of the same image and size right
+		next to one of theirs on the same page, to the right or above
+
+		Runs of these can be merged into one quad with repeating tex coords
+		"""
+		buffer = self.buffer
+		strings = self.strings
+		repeated = set()
+		for page in range(self.pages_x * self.pages_y):
+			index = self.page_table_offset + page * PAGE_INDEX.size
+			start = PAGE_INDEX.unpack_from(buffer, index)[0]
+			stop = PAGE_INDEX.unpack_from(buffer, index + PAGE_INDEX.size)[0]
+			tiles = set([TILE.unpack_from(buffer, offset)
+						 for offset in range(self.tiles_offset + start * TILE.size,
+											 self.tiles_offset + stop * TILE.size, TILE.size)])
+			for x, y, width, height, image in tiles:
+				if (x + width, y, width, height, image) in tiles or \
+				   (x, y + height, width, height, image) in tiles:
+					repeated.add(strings[image])
+		return repeated
+
+	def entities(self):
+		"""Return [(name, value, x, y), ...]"""
+		strings = self.strings
+		entities = []
+		for i in range(self.entity_count):
+			name, value, x, y = ENTITY.unpack_from(self.buffer, self.entities_offset + i * ENTITY.size)
+			entities.append((strings[name], strings[value], x, y))
+		return entities
+
+	def close(self):
+		"""Unmap the compiled level, it can't be read afterwards"""
+		if isinstance(self.buffer, mmap.mmap):
+			self.buffer.close()
+		if self.source is not None:
+			self.source.close()
+		self.buffer = None
+		self.source = None
+
+
+def map_level(level_file):
+	"""Memory map a compiled level, return None if it can't be used"""
+	try:
+		compiled = open(compiled_name(level_file), 'rb')
+	except IOError:
+		return None
+	try:
+		buffer = mmap.mmap(compiled.fileno(), 0, access=mmap.ACCESS_READ)
+		return LevelData(buffer, compiled)
+	except (ValueError, EnvironmentError, struct.error):
+		compiled.close()
+		return None
+
+def load_level(level_file, tile_size, page_size):
+	"""
+	Return LevelData for an SVG level
+
+	Use the compiled level if its content hash matches the SVG, otherwise
+	recompile and try to save the result for next time
+	"""
+	data = map_level(level_file)
+	if data is not None:
+		if data.digest == svg_digest(level_file) \
+		   and data.tile_size == tile_size and data.page_size == page_size:
+			return data
+		data.close()
+
+	print "Compiling level %s" % level_file
+	compiled = compile_level(level_file, tile_size, page_size)
+	
+	# Write next to the old file and swap it in, so a level still mapped by
+	# another Level keeps its data and a failed write leaves nothing behind
+	temp_name = compiled_name(level_file) + '.tmp'
+	try:
+		compiled_file = open(temp_name, 'wb')
+		try:
+			compiled_file.write(compiled)
+		finally:
+			compiled_file.close()
+		if os.name == 'nt' and path.exists(compiled_name(level_file)):
+			os.remove(compiled_name(level_file))
+		os.rename(temp_name, compiled_name(level_file))
+	except EnvironmentError:
+		print "Unable to save compiled level %s" % compiled_name(level_file)
+		if path.exists(temp_name):
+			try:
+				os.remove(temp_name)
+			except EnvironmentError:
+				pass
+		return LevelData(compiled)
+	return map_level(level_file) or LevelData(compiled)
@@ -23,6 +23,7 @@ along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 from menu import MenuLoader
 from gamestate import ToastWin, Level3
+from sprites import render_queue
 
 # Pygame
 try:
@@ -41,6 +42,16 @@ except ImportError:
 	sys.exit('PyOpenGL was not found')
 
 
+#------------------------------------------------------------------------------
+#   Globals
+#------------------------------------------------------------------------------
+
+# Simulation steps per second
+SIMULATION_RATE = 120
+# Most steps run in one frame, time past them is dropped
+MAX_STEPS = 6
+
+
 #------------------------------------------------------------------------------
 #   Main
 #------------------------------------------------------------------------------
@@ -63,16 +74,24 @@ class Main:
 		# Gameplay area
 		self.width = 800.0
 		self.height = 600.0
+		# Draw the next frame even if every state is static
+		self.redraw = True
+		# Milliseconds per simulation step, and time not yet simulated
+		self.step = 1000.0 / SIMULATION_RATE
+		self.max_steps = MAX_STEPS
+		self.accumulator = 0.0
 
 	def add_game_state(self, game_state):
 		"""Append Game State object to list"""
 		self.active_state.append(game_state)
 		game_state.start()
+		self.redraw = True
 
 	def rem_game_state(self, game_state):
 		"""Remove Game State object from list"""
 		try:
 			self.active_state.remove(game_state)
+			self.redraw = True
 		except:
 			print "Remove gamestate failed: not found in list"
 	
@@ -95,6 +114,8 @@ class Main:
 		for game_state in self.active_state:
 			if game_state not in white_list:
 				game_state.running = True
+				game_state.thaw()
+		self.redraw = True
 		
 	def handle_event(self, event):
 		"""
@@ -102,8 +123,10 @@ class Main:
 
         Stop program gracefully if QUIT event is received,
         else pass event to .handle_event() method of primary
-        active_state object.
+        active_state object. Any event, like VIDEOEXPOSE, redraws the
+        next frame.
         """
+		self.redraw = True
 		if event.type == QUIT:
 			self.running = False
 			return True
@@ -113,14 +136,69 @@ class Main:
 					return True
 
 	def tick(self, interval):
-		"""Execute tick() method for each active_state object"""
+		"""
+		Simulate interval milliseconds in fixed steps, then draw a frame
+		
+		Running states update() once per step of self.step milliseconds,
+		time short of a step carries over to the next frame. After
+		max_steps the rest is dropped, so a slow frame slows the game down
+		rather than taking ever more steps. draw() gets how far into the
+		next step the frame is, for interpolating.
+		
+		Paused states draw a copy of their first paused frame. If every state
+		is static and nothing asked for a redraw, the frame is skipped and
+		the last one stays on screen. Return True if a frame was drawn
+		"""
+		if not self.redraw:
+			for game_state in self.active_state:
+				if not game_state.static():
+					break
+			else:
+				return False
+		self.redraw = False
+		self.accumulator += interval
+		steps = 0
+		while self.accumulator >= self.step:
+			if steps == self.max_steps:
+				self.accumulator %= self.step
+				break
+			# States can stop or add states as they update
+			for game_state in self.active_state[:]:
+				if game_state.running == True:
+					game_state.update(self.step)
+			self.accumulator -= self.step
+			steps += 1
+		blend = self.accumulator / self.step
 		glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-		for game_state in self.active_state:
+		for game_state in self.active_state[:]:
 			if game_state.running == True:
-				game_state.tick(interval)
-			else:
-				game_state.tick(0)
+				game_state.draw(blend)
+			elif game_state in self.active_state:
+				game_state.paused_tick()
 		pygame.display.flip()
+		render_queue.end_frame()
+		return True
+	
+	def setup_gl(self):
+		"""Set the viewport to the gameplay area and the OpenGL options"""
+		# OpenGL viewport
+		glViewport(0, 0, self.res_x, self.res_y)
+		glMatrixMode(GL_PROJECTION)
+		glLoadIdentity()
+		gluOrtho2D(0.0, float(self.width), 0.0, float(self.height))
+		glMatrixMode(GL_MODELVIEW)
+		glLoadIdentity()
+
+		# OpenGL options
+		glEnable(GL_TEXTURE_2D)
+		glEnable(GL_BLEND)
+		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+		glShadeModel(GL_SMOOTH)
+		glClearColor(0.0, 0.0, 0.0, 0.0)
+		glClearDepth(1.0)
+		glEnable(GL_DEPTH_TEST)
+		glDepthFunc(GL_LEQUAL)
+		#OpenGL.error.ErrorChecker.registerChecker(error.ErrorChecker.nullGetError)
 	
 	def run(self):
 		"""
@@ -159,24 +237,7 @@ class Main:
 				self.stick = stik
 				break
 
-		# OpenGL viewport
-		glViewport(0, 0, res_x, res_y)
-		glMatrixMode(GL_PROJECTION)
-		glLoadIdentity()
-		gluOrtho2D(0.0, float(width), 0.0, float(height))
-		glMatrixMode(GL_MODELVIEW)
-		glLoadIdentity()
-
-		# OpenGL options
-		glEnable(GL_TEXTURE_2D)
-		glEnable(GL_BLEND)
-		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-		glShadeModel(GL_SMOOTH)
-		glClearColor(0.0, 0.0, 0.0, 0.0)
-		glClearDepth(1.0)
-		glEnable(GL_DEPTH_TEST)
-		glDepthFunc(GL_LEQUAL)
-		#OpenGL.error.ErrorChecker.registerChecker(error.ErrorChecker.nullGetError)
+		self.setup_gl()
 
 		# Clock
 		clock = pygame.time.Clock()
@@ -195,8 +256,6 @@ class Main:
 				interval = clock.tick(60)
 			else:
 				interval = clock.tick()
-			if interval > 50:
-				interval = 50
 			timer += interval
 			self.tick(interval)
 			[self.handle_event(event) for event in pygame.event.get()]
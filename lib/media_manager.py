@@ -21,113 +21,540 @@ along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
 from os import path
+import math
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import pygame
 from pygame import image, mixer, font
 from OpenGL.GL import *
-from xml.dom import minidom
+from resource_manager import resources, asset_stats
+
+
+#------------------------------------------------------------------------------
+#   Globals
+#------------------------------------------------------------------------------
+
+# Texels of edge copies around each atlas image, so filtering at the edge
+# of a region can't pick up its neighbours
+ATLAS_PADDING = 2
+ATLAS_MAX_SIZE = 2048
+# Bigger images keep their own texture
+ATLAS_IMAGE_LIMIT = 256
+# Characters rendered into glyph atlases, others are drawn as '?'
+GLYPHS = ''.join([chr(c) for c in range(32, 127)])
 
 
 #------------------------------------------------------------------------------
 #   Media Manager
 #------------------------------------------------------------------------------
 
+class OpacityMap:
+	"""
+	Which parts of an RGBA image are completely opaque
+	
+	The image is split into at most blocks x blocks blocks, rows are bottom
+	up like the texture data
+	"""
+	
+	def __init__(self, width, height, texture_data, blocks=16):
+		self.width = width
+		self.height = height
+		self.block_width = int(math.ceil(float(width) / min(blocks, width)))
+		self.block_height = int(math.ceil(float(height) / min(blocks, height)))
+		self.blocks_x = int(math.ceil(float(width) / self.block_width))
+		self.blocks_y = int(math.ceil(float(height) / self.block_height))
+		self.opaque = [True] * (self.blocks_x * self.blocks_y)
+		
+		alpha = texture_data[3::4]
+		opaque_run = '\xff' * self.block_width
+		for row in range(height):
+			block_row = row / self.block_height * self.blocks_x
+			start = row * width
+			for block_x in range(self.blocks_x):
+				left = block_x * self.block_width
+				run = alpha[start + left:start + min(left + self.block_width, width)]
+				if run != opaque_run[:len(run)]:
+					self.opaque[block_row + block_x] = False
+		self.solid = False not in self.opaque
+		
+	def covers(self, x1, y1, x2, y2):
+		"""
+		Return True if texels x1 <= x < x2, y1 <= y < y2 are opaque
+		
+		The area is grown by a texel so filtering can't blend in its neighbours
+		"""
+		if self.solid:
+			return True
+		x1 = max(int(x1) - 1, 0) / self.block_width
+		y1 = max(int(y1) - 1, 0) / self.block_height
+		x2 = min(int(math.ceil(x2)) + 1, self.width)
+		y2 = min(int(math.ceil(y2)) + 1, self.height)
+		for block_y in range(y1, (y2 - 1) / self.block_height + 1):
+			row = block_y * self.blocks_x
+			for block_x in range(x1, (x2 - 1) / self.block_width + 1):
+				if not self.opaque[row + block_x]:
+					return False
+		return True
+		
+
+class TextureAtlas:
+	"""
+	RGBA images packed into shelves of one texture
+	
+	Each image is surrounded by padding filled with copies of its edge
+	texels. Rows are bottom up like the texture data.
+	"""
+	
+	def __init__(self, width, height, padding=ATLAS_PADDING):
+		self.width = width
+		self.height = height
+		self.padding = padding
+		# [[y, height, width used], ...]
+		self.shelves = []
+		self.top = 0
+		# (x, y, width, height) by image name
+		self.images = {}
+		# Made by the first blit, so trying sizes with place() is cheap
+		self.texture_data = None
+		
+	def place(self, width, height):
+		"""Make room for an image and its padding, return (x, y) or None if there's none"""
+		padded_width = width + self.padding * 2
+		padded_height = height + self.padding * 2
+		if padded_width > self.width:
+			return None
+		for shelf in self.shelves:
+			if padded_height <= shelf[1] and shelf[2] + padded_width <= self.width:
+				break
+		else:
+			if self.top + padded_height > self.height:
+				return None
+			shelf = [self.top, padded_height, 0]
+			self.shelves.append(shelf)
+			self.top += padded_height
+		x = shelf[2]
+		shelf[2] += padded_width
+		return x, shelf[0]
+		
+	def add(self, name, width, height, texture_data):
+		"""Pack image, return False if there's no room for it"""
+		position = self.place(width, height)
+		if position is None:
+			return False
+		x, y = position
+		self.blit(x, y, width, height, texture_data)
+		self.images[name] = (x + self.padding, y + self.padding, width, height)
+		return True
+	
+	def blit(self, x, y, width, height, texture_data):
+		"""Copy image to x, y with its edges extruded into the padding"""
+		if self.texture_data is None:
+			self.texture_data = bytearray(self.width * self.height * 4)
+		padding = self.padding
+		row_size = width * 4
+		for row in range(-padding, height + padding):
+			source_row = min(max(row, 0), height - 1) * row_size
+			source = texture_data[source_row:source_row + row_size]
+			start = ((y + padding + row) * self.width + x) * 4
+			self.texture_data[start:start + row_size + padding * 8] = \
+				source[:4] * padding + source + source[-4:] * padding
+				
+	def trim(self):
+		"""Drop unused shelf space, keeping the height a power of two"""
+		while self.height / 2 >= self.top and self.height > 1:
+			self.height /= 2
+		del self.texture_data[self.width * self.height * 4:]
+			
+	def region(self, name):
+		"""Return tex coords (u1, v1, u2, v2) of a packed image"""
+		x, y, width, height = self.images[name]
+		return (float(x) / self.width, float(y) / self.height,
+				float(x + width) / self.width, float(y + height) / self.height)
+		
+
+def fit_atlas(sizes, max_size):
+	"""
+	Return the side of the smallest power of two atlas that packs every
+	(width, height) of sizes in order, or max_size if none up to it does
+	
+	Sizes are tried by packing, so padding and the space left at the end
+	of shelves are counted
+	"""
+	size = 64
+	while size < max_size:
+		atlas = TextureAtlas(size, size)
+		for width, height in sizes:
+			if atlas.place(width, height) is None:
+				break
+		else:
+			return size
+		size *= 2
+	return max_size
+		
+
+class Decoded:
+	"""Result of decode_images when every image was already decoded"""
+	
+	def ready(self):
+		return True
+		
+	def wait(self, timeout=None):
+		pass
+		
+	def get(self, timeout=None):
+		return []
+		
+
 class MediaManage:
 	
 	def __init__(self):
 		self.base_dir = "data"
+		# asset_path results by (name, sub_dir), tiles look theirs up often
+		self.paths = {}
+		# Textures, sounds and fonts are keyed by asset_path, and by load
+		# parameters. Textures made from surfaces are keyed by name
 		self.textures = {}
+		# (width, height) of textures
+		self.texture_sizes = {}
+		# Regions, decoded images and opacity maps are keyed by asset_path
+		# (texture, u1, v1, u2, v2) of images packed into atlases
+		self.regions = {}
+		# Images decoded off the main thread, waiting for upload
+		self.decoded = {}
+		# OpacityMaps of decoded images
+		self.opacity = {}
 		self.sounds = {}
 		self.fonts = {}
+		# (texture, {character: (width, height, tex_coords)}) of glyph atlases
+		self.glyphs = {}
 		self.default_image = pygame.Surface((1, 1))
 		self.default_image.fill((255, 0, 255))
 	
+	def image_path(self, name, sub_dir='images'):
+		"""Return file path of an image"""
+		proper_sub_dir = ""
+		for dir in sub_dir.replace('\\', '/').split('/'):
+			proper_sub_dir = path.join(proper_sub_dir, dir)
+		return path.join(self.base_dir, proper_sub_dir, name)
+	
+	def asset_path(self, name, sub_dir='images'):
+		"""Return canonical path of a file, cache key of what's loaded from it"""
+		try:
+			return self.paths[(name, sub_dir)]
+		except KeyError:
+			fqpn = path.normcase(path.normpath(self.image_path(name, sub_dir)))
+			self.paths[(name, sub_dir)] = fqpn
+			return fqpn
+	
 	def load_image(self, name, sub_dir='images'):
 		"""Load image from file, return dimensions"""
 		try:
-			proper_sub_dir = ""
-			for dir in sub_dir.replace('\\', '/').split('/'):
-				proper_sub_dir = path.join(proper_sub_dir, dir)
-			fqpn = path.join(self.base_dir, proper_sub_dir, name)
+			fqpn = self.image_path(name, sub_dir)
 			image_obj = image.load(fqpn).convert_alpha()
 			return image_obj
 		except:
 			print "Error occurred loading %s from %s" % \
 				  (name, fqpn)
 			return self.default_image
+	
+	def decode_image(self, name, sub_dir='images'):
+		"""
+		Decode image to RGBA data ready for upload
+		
+		Doesn't touch the display or GL, so it can run in a worker thread.
+		The result is kept until load_texture asks for it, its OpacityMap
+		is kept in self.opacity.
+		"""
+		if self.is_decoded(name, sub_dir):
+			return
+		key = self.asset_path(name, sub_dir)
+		try:
+			fqpn = self.image_path(name, sub_dir)
+			image_obj = image.load(fqpn)
+			width = image_obj.get_width()
+			height = image_obj.get_height()
+			texture_data = image.tostring(image_obj, "RGBA", 1)
+			self.opacity[key] = OpacityMap(width, height, texture_data)
+			self.decoded[key] = (width, height, texture_data)
+		except:
+			print "Error occurred decoding %s from %s" % \
+				  (name, fqpn)
+	
+	def decode_images(self, names, sub_dir='images'):
+		"""
+		Decode images with decode_image in a pool of threads
+		
+		pygame releases the GIL while decoding, so this scales with cores.
+		Return the pool result, wait() on it or poll ready(). No pool is
+		started when there's nothing to decode
+		"""
+		names = [name for name in names if not self.is_decoded(name, sub_dir)]
+		if not names:
+			return Decoded()
+		try:
+			threads = cpu_count()
+		except NotImplementedError:
+			threads = 2
+		pool = ThreadPool(min(threads, len(names)))
+		result = pool.map_async(lambda name: self.decode_image(name, sub_dir), names)
+		pool.close()
+		return result
+			
+	def forget_decoded(self, names, sub_dir='images'):
+		"""Drop decoded images, and their OpacityMaps, that won't be uploaded after all"""
+		for name in names:
+			key = self.asset_path(name, sub_dir)
+			self.decoded.pop(key, None)
+			self.opacity.pop(key, None)
 			
-	def save_texture(self, name, image_obj):
+	def is_decoded(self, name, sub_dir='images'):
+		"""Return True if an image is decoded, uploaded or packed into an atlas"""
+		key = self.asset_path(name, sub_dir)
+		return key in self.textures or key in self.decoded or key in self.regions
+		
+	def opacity_maps(self, names, sub_dir='images'):
+		"""Return {name: OpacityMap} of the decoded images among names"""
+		maps = {}
+		for name in names:
+			opacity = self.opacity.get(self.asset_path(name, sub_dir))
+			if opacity is not None:
+				maps[name] = opacity
+		return maps
+		
+	def save_texture(self, name, image_obj, owner=None):
 		"""Add pygame surface to video memory"""
+		texture_data = image.tostring(image_obj, "RGBA", 1)
+		return self.upload_texture(name, image_obj.get_width(), 
+								   image_obj.get_height(), texture_data, owner)
+	
+	def upload_texture(self, name, width, height, texture_data, owner=None):
+		"""Add RGBA data to video memory, held by owner"""
 		self.textures[name] = glGenTextures(1)
+		self.texture_sizes[name] = (width, height)
+		resources.add('texture', self.textures[name], width * height * 4, owner, 
+					  self.forget_texture)
 		
-		texture_data = image.tostring(image_obj, "RGBA", 1)
 		glBindTexture(GL_TEXTURE_2D, self.textures[name])
-		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, image_obj.get_width(),
-					 image_obj.get_height(), 0, GL_RGBA, GL_UNSIGNED_BYTE, 
-					 texture_data);
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, 
+					 GL_UNSIGNED_BYTE, texture_data);
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
 
 		return self.textures[name]
 	
-	def load_texture(self, name, image_obj=None, sub_dir='images'):
+	def load_texture(self, name, image_obj=None, sub_dir='images', owner=None):
 		"""
-		Load texture into video memory
-		Return GL texture index
+		Load texture into video memory, held by owner
+		
+		Without image_obj the image is loaded from sub_dir, otherwise the
+		surface is uploaded under name. Return GL texture index
 		"""
+		if image_obj is None:
+			key = self.asset_path(name, sub_dir)
+		else:
+			key = name
 		try:
-			return self.textures[name]
+			texture = self.textures[key]
 		except KeyError:
 			if image_obj is None:
+				decoded = self.decoded.pop(key, None)
+				if decoded is not None:
+					width, height, texture_data = decoded
+					asset_stats.miss('texture', width * height * 4)
+					return self.upload_texture(key, width, height, texture_data, owner)
 				image_obj = self.load_image(name, sub_dir)
-			return self.save_texture(name, image_obj)
+			asset_stats.miss('texture', image_obj.get_width() * image_obj.get_height() * 4)
+			return self.save_texture(key, image_obj, owner)
+		asset_stats.hit('texture')
+		resources.use('texture', texture, owner)
+		return texture
+		
+	def texture_size(self, name, sub_dir='images'):
+		"""Return (width, height) of an image loaded by load_texture"""
+		return self.texture_sizes[self.asset_path(name, sub_dir)]
+	
+	def iter_build_atlas(self, name, names, sub_dir='images', owner=None):
+		"""
+		Pack decoded images into atlas textures held by owner
+		
+		Images bigger than ATLAS_IMAGE_LIMIT, or already packed, are left
+		alone. Yields the number of atlas textures made so far after each
+		image is packed and each atlas is uploaded, so loading can spread
+		the work over frames
+		"""
+		images = []
+		for key in set([self.asset_path(image_name, sub_dir) for image_name in names]):
+			decoded = self.decoded.get(key)
+			if key in self.regions or decoded is None:
+				continue
+			width, height = decoded[:2]
+			if max(width, height) <= ATLAS_IMAGE_LIMIT:
+				images.append((height, width, key))
+		# Tallest first packs shelves tightest
+		images.sort(reverse=True)
+		
+		max_size = min(int(glGetIntegerv(GL_MAX_TEXTURE_SIZE)), ATLAS_MAX_SIZE)
+		atlas_count = 0
+		while images:
+			# A second atlas is only started once one of max_size is full
+			size = fit_atlas([(image[1], image[0]) for image in images], max_size)
+			atlas = TextureAtlas(size, size)
+			left = []
+			for height, width, key in images:
+				if not atlas.add(key, width, height, self.decoded[key][2]):
+					left.append((height, width, key))
+				yield atlas_count
+			if len(left) == len(images):
+				break
+			atlas.trim()
+			texture = self.upload_texture("%s_atlas_%d" % (name, atlas_count), atlas.width,
+										  atlas.height, str(atlas.texture_data), owner)
+			asset_stats.miss('atlas', atlas.width * atlas.height * 4)
+			for key in atlas.images:
+				self.regions[key] = (texture,) + atlas.region(key)
+				del self.decoded[key]
+			atlas_count += 1
+			images = left
+			yield atlas_count
+	
+	def texture_region(self, name, sub_dir='images', owner=None):
+		"""
+		Return (texture, u1, v1, u2, v2) of an image, held by owner
+		
+		Images packed by iter_build_atlas are a region of an atlas texture, the
+		rest cover the whole of their own texture
+		"""
+		try:
+			region = self.regions[self.asset_path(name, sub_dir)]
+		except KeyError:
+			return (self.load_texture(name, sub_dir=sub_dir, owner=owner), 0.0, 0.0, 1.0, 1.0)
+		asset_stats.hit('atlas')
+		resources.use('texture', region[0], owner)
+		return region
+	
+	def capture_texture(self, width, height, owner=None):
+		"""
+		Copy width x height of the back buffer into a new texture
+		
+		The texture is rounded up to powers of two, return (texture, s, t)
+		where s, t are the tex coords of the copy's far corner
+		"""
+		texture_width = 2 ** int(math.ceil(math.log(width, 2)))
+		texture_height = 2 ** int(math.ceil(math.log(height, 2)))
+		texture = glGenTextures(1)
+		glBindTexture(GL_TEXTURE_2D, texture)
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, texture_width, texture_height, 0, GL_RGB, 
+					 GL_UNSIGNED_BYTE, None)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+		glCopyTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, 0, 0, width, height)
+		resources.add('texture', texture, texture_width * texture_height * 3, owner)
+		return (texture, float(width) / texture_width, float(height) / texture_height)
+	
+	def forget_texture(self, texture):
+		"""Drop cache entries of a deleted texture"""
+		for name, cached in self.textures.items():
+			if cached == texture:
+				del self.textures[name]
+				del self.texture_sizes[name]
+		for name, region in self.regions.items():
+			if region[0] == texture:
+				del self.regions[name]
+		for name, glyphs in self.glyphs.items():
+			if glyphs[0] == texture:
+				del self.glyphs[name]
 	
 	def clear_textures(self):
+		"""Delete every texture loaded through this manager"""
+		for texture in set(self.textures.values()):
+			resources.delete('texture', texture)
 		self.textures = {}
+		self.texture_sizes = {}
+		self.regions = {}
+		self.glyphs = {}
 		
 	def load_sound(self, name):
 		"""Load Sound at 40% volume by default"""
+		fqpn = self.asset_path(name, 'sounds')
 		try:
-			return self.sounds[name]
+			sound_obj = self.sounds[fqpn]
 		except KeyError:
 			try:
-				fqpn = path.join(self.base_dir, 'sounds', name)
 				sound_obj = mixer.Sound(fqpn)
 				sound_obj.set_volume(0.4)
-				self.sounds[name] = sound_obj
+				self.sounds[fqpn] = sound_obj
+				# Decoded samples, frequency * seconds * channels * sample size
+				frequency, format, channels = mixer.get_init()
+				asset_stats.miss('sound', int(frequency * sound_obj.get_length()) * 
+								 channels * abs(format) / 8)
 				return sound_obj
 			except:
 				print "Error occurred loading %s from %s" % \
 					  (name, fqpn)
 				raise SystemExit
+		asset_stats.hit('sound')
+		return sound_obj
 	
 	def clear_sounds(self):
 		self.sounds = {}
 		
 	def load_font(self, name, size):
-		font_name = "%s_%s" % (name, size)
+		fqpn = self.asset_path(name, 'fonts')
 		try:
-			return self.fonts[font_name]
+			font_obj = self.fonts[(fqpn, size)]
 		except KeyError:
 			try:
-				fqpn = path.join(self.base_dir, 'fonts', name)
 				font_obj = font.Font(fqpn, size)
-				self.fonts[font_name] = font_obj
+				self.fonts[(fqpn, size)] = font_obj
+				asset_stats.miss('font', path.getsize(fqpn))
 				return font_obj
 			except:
 				print "Error occurred loading %s from %s" % \
 					  (name, fqpn)
 				raise SystemExit
+		asset_stats.hit('font')
+		return font_obj
 			
-	def clear_fonts(self):
-		self.fonts = {}
+	def load_glyphs(self, name, size, color):
+		"""
+		Return (texture, glyphs) of a font's glyph atlas
 		
-	def load_xml(self, xml_file):
-		"""Load XML file, return, don't keep in media manager"""
-		fqpn = path.join('data', 'levels', xml_file)
+		Every character in GLYPHS is rendered once in color and packed into
+		one texture. glyphs maps each character to (width, height,
+		tex_coords), text is laid out from these without touching GL
+		"""
+		key = (self.asset_path(name, 'fonts'), size, tuple(color))
 		try:
-			xml_doc = minidom.parse(fqpn)
-			return xml_doc
-		except:
-			print "Error occurred loading %s from %s" % \
-				  (xml_file, fqpn)
-			raise SystemExit
+			glyph_atlas = self.glyphs[key]
+		except KeyError:
+			atlas_name = "%s_%s_glyphs_%d_%d_%d" % ((name, size) + tuple(color))
+			font_obj = self.load_font(name, size)
+			rendered = [(char, font_obj.render(char, 1, color)) for char in GLYPHS]
+			atlas_size = fit_atlas([surface.get_size() for char, surface in rendered], 
+								   ATLAS_MAX_SIZE)
+			atlas = TextureAtlas(atlas_size, atlas_size)
+			for char, surface in rendered:
+				if not atlas.add(char, surface.get_width(), surface.get_height(), 
+								 image.tostring(surface, "RGBA", 1)):
+					print "Glyph atlas %s is full" % atlas_name
+			atlas.trim()
+			texture = self.upload_texture(atlas_name, atlas.width, atlas.height, 
+										  str(atlas.texture_data))
+			glyphs = {}
+			for char, surface in rendered:
+				if char in atlas.images:
+					u1, v1, u2, v2 = atlas.region(char)
+					glyphs[char] = (surface.get_width(), surface.get_height(),
+									((u1, v1), (u2, v1), (u2, v2), (u1, v2)))
+			self.glyphs[key] = (texture, glyphs)
+			asset_stats.miss('glyphs', atlas.width * atlas.height * 4)
+			return self.glyphs[key]
+		asset_stats.hit('glyphs')
+		return glyph_atlas
+			
+	def clear_fonts(self):
+		self.fonts = {}
+
+
+# The one MediaManage every module loads through, so nothing is loaded twice
+media_manager = MediaManage()
@@ -21,9 +21,10 @@ along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
 import gamestate
+import level
 from gamestate import GameState
-from sprites import GLSpriteGroup, ColorBackground, ImageBackground, GLText
-from media_manager import MediaManage
+from sprites import GLSpriteGroup, ColorBackground, ImageBackground, GLText, render_queue
+from media_manager import media_manager
 
 import pygame
 from pygame.locals import *
@@ -31,13 +32,6 @@ from OpenGL.GL import *
 from OpenGL.GLU import gluOrtho2D
 
 
-#------------------------------------------------------------------------------
-#   Globals
-#------------------------------------------------------------------------------
-
-media_manager = MediaManage()
-
-
 #------------------------------------------------------------------------------
 #   Menu
 #------------------------------------------------------------------------------
@@ -57,7 +51,7 @@ class MenuLoader(GameState):
 		self.menu_added = False
 		self.background_alpha = 1.0
 		
-	def tick(self, interval):
+	def update(self, interval):
 		# Add main menu
 		if not self.menu_added:
 			self.parent.add_game_state(MainMenu(self.parent))
@@ -72,9 +66,8 @@ class MenuLoader(GameState):
 		if self.timer <= 0:
 			self.stop()
 		
-		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
-		self.g_background.draw()
-		glColor4f(1.0, 1.0, 1.0, 1.0)
+	def draw(self, blend=1.0):
+		self.g_background.draw(alpha=self.background_alpha)
 		
 
 class Menu(GameState):
@@ -103,6 +96,8 @@ class MainMenu(Menu):
 	
 	def __init__(self, parent):
 		Menu.__init__(self, parent)
+		# Levels preloaded for the next level won't be played from here
+		level.drop_preloads()
 		center_x = self.width / 2
 		center_y = self.height / 2
 		# Sprite Groups
@@ -110,8 +105,9 @@ class MainMenu(Menu):
 		self.g_menu = GLSpriteGroup()
 		# Sprites
 		background = ColorBackground(0, 0, self.width, self.height, (255, 255, 255))
-		robot_toast = ImageBackground(-112.0, center_y + 20, 1024.0, 256.0, 'logo.png')
-		robot = ImageBackground(self.width - 350, -95.0, 256.0, 512.0, 'ninjabot_stand_big.png')
+		robot_toast = ImageBackground(-112.0, center_y + 20, 1024.0, 256.0, 'logo.png', owner=self)
+		robot = ImageBackground(self.width - 350, -95.0, 256.0, 512.0, 'ninjabot_stand_big.png', 
+								owner=self)
 		start_game = GLText('Start', center_x, center_y - 10, size=40, halign='middle')
 		start_game.action = self.start_game
 		quit_ = GLText('Quit', center_x, center_y - 70, size=40, halign='middle')
@@ -140,10 +136,13 @@ class MainMenu(Menu):
 		#self.intro_music = media_manager.load_sound('title_screen_loop.ogg')
 		self.music.play()
 
+	def static(self):
+		return not (self.transition_in or self.transition_out)
+
 	def start_game(self):
 		self.transition_out = True
 		print "Loading level"
-		self.parent.add_game_state(gamestate.Level1(self.parent))
+		self.parent.add_game_state(gamestate.Loading(self.parent, gamestate.Level1))
 		self.music.fadeout(1000)
 		
 	def quit_game(self):
@@ -180,9 +179,9 @@ class MainMenu(Menu):
 					stuff.action()
 		return True
 	
-	def tick(self, interval):
-		"""Functions called every frame """
-		Menu.tick(self, interval)
+	def update(self, interval):
+		"""Follow the mouse and fade in or zoom out"""
+		Menu.update(self, interval)
 		posx, posy = pygame.mouse.get_pos()
 		posy = self.height - posy
 		
@@ -215,8 +214,8 @@ class MainMenu(Menu):
 			if self.zoom < 0.002:
 				self.stop()
 				
-		glColor4f(1.0, 1.0, 1.0, self.background_alpha)
-		self.g_background.draw()
+	def draw(self, blend=1.0):
+		self.g_background.draw(alpha=self.background_alpha)
 		
 		# Zoom for menu
 		zoom_width = (self.width * self.zoom - self.width)
@@ -228,11 +227,9 @@ class MainMenu(Menu):
 		glMatrixMode(GL_PROJECTION)
 		glLoadIdentity()
 		gluOrtho2D(left, right, bottom, top)
-		glColor4f(1.0, 1.0, 1.0, self.menu_alpha)
-		self.g_menu.draw()
+		self.g_menu.draw(alpha=self.menu_alpha)
 		
 		# Reset view
-		glColor4f(1.0, 1.0, 1.0, 1.0)
 		glMatrixMode(GL_PROJECTION)
 		glLoadIdentity()
 		gluOrtho2D(0.0, self.width, 0.0, self.height)
@@ -280,6 +277,9 @@ class GameMenu(Menu):
 		Menu.stop(self)
 		self.parent.unpause()
 		
+	def static(self):
+		return not (self.fade_in or self.fade_out)
+		
 	def resume_game(self):
 		self.fade_out = 0.01
 		
@@ -321,9 +321,9 @@ class GameMenu(Menu):
 					stuff.action()
 		return True
 	
-	def tick(self, interval):
-		"""Functions called every frame """
-		Menu.tick(self, interval)
+	def update(self, interval):
+		"""Follow the mouse and fade in or out"""
+		Menu.update(self, interval)
 		posx, posy = pygame.mouse.get_pos()
 		posy = self.height - posy
 		
@@ -345,11 +345,11 @@ class GameMenu(Menu):
 				self.fade_out = False
 				if self.restart_level:
 					self.level.leave_level()
-					self.parent.add_game_state(self.level.current_level(self.parent))
+					self.parent.add_game_state(gamestate.Loading(self.parent, self.level.current_level))
 				self.stop()
-		glColor4f(1.0, 1.0, 1.0, self.alpha * 0.7)
-		self.g_background.draw()
-		glColor4f(1.0, 1.0, 1.0, self.alpha)
-		self.g_menu.draw()
-		glColor4f(1.0, 1.0, 1.0, 1.0)
+				
+	def draw(self, blend=1.0):
+		self.g_background.queue(0, self.alpha * 0.7)
+		self.g_menu.queue(1, self.alpha)
+		render_queue.flush()
 		
\ No newline at end of file
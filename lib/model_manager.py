@@ -20,26 +20,236 @@ along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
 #   Imports
 #------------------------------------------------------------------------------
 
+import math
+import ctypes
+from array import array
 from pygame import image
 from OpenGL.GL import *
+from resource_manager import resources, asset_stats
 
 
 #------------------------------------------------------------------------------
 #   Model Manager
 #------------------------------------------------------------------------------
 
+# Tile tex coords are pulled in by this much so rounding at the edge of a
+# quad can't wrap round to the far side of a repeating texture
+TILE_INSET = 0.0001
+# Tex coords of a region covering its whole texture, only these can repeat
+WHOLE_TEXTURE = (0.0, 0.0, 1.0, 1.0)
+# Tile mesh vertices are x, y, u, v floats
+VERTEX_SIZE = 4
+VERTEX_STRIDE = VERTEX_SIZE * 4
+# Rough bytes of a quad display list, for resource counts
+QUAD_LIST_SIZE = 4 * 5 * 4
+QUAD_TEX_COORDS = ((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0))
+# Default blend function of the render queue
+BLEND_ALPHA = (GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+
+
+class TileMesh:
+	"""
+	Quads in an interleaved vertex buffer, drawn in ranges by texture
+	
+	Each quad is stored as two triangles, as GL_QUADS isn't available to
+	glDrawArrays everywhere.
+	
+	Falls back to client side vertex arrays without vertex buffer support
+	"""
+	
+	def __init__(self, vertex_data, ranges, owner=None):
+		# [(texture, first vertex, vertex count), ...]
+		self.ranges = ranges
+		self.size = len(vertex_data)
+		if bool(glGenBuffers):
+			self.buffer = glGenBuffers(1)
+			glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+			glBufferData(GL_ARRAY_BUFFER, self.size, vertex_data, GL_STATIC_DRAW)
+			glBindBuffer(GL_ARRAY_BUFFER, 0)
+			resources.add('buffer', self.buffer, self.size, owner)
+			self.vertex_data = None
+			self.address = 0
+		else:
+			self.buffer = None
+			self.vertex_data = ctypes.create_string_buffer(vertex_data, self.size)
+			self.address = ctypes.addressof(self.vertex_data)
+		
+	def draw(self):
+		if self.buffer is not None:
+			glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+		glEnableClientState(GL_VERTEX_ARRAY)
+		glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+		glVertexPointer(2, GL_FLOAT, VERTEX_STRIDE, ctypes.c_void_p(self.address))
+		glTexCoordPointer(2, GL_FLOAT, VERTEX_STRIDE, ctypes.c_void_p(self.address + 8))
+		for texture, first, count in self.ranges:
+			glBindTexture(GL_TEXTURE_2D, texture)
+			glDrawArrays(GL_TRIANGLES, first, count)
+		glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+		glDisableClientState(GL_VERTEX_ARRAY)
+		if self.buffer is not None:
+			glBindBuffer(GL_ARRAY_BUFFER, 0)
+			
+	def delete(self):
+		if self.buffer is not None:
+			resources.delete('buffer', self.buffer)
+			self.buffer = None
+		self.vertex_data = None
+		self.ranges = []
+
+class RenderQueue:
+	"""
+	Sprite quads sorted by (layer, blend, alpha, texture) and drawn from
+	a client side vertex array
+	
+	Quads are added under the current state, see set_state(). flush()
+	sorts them and only changes blend function, colour or texture when
+	the key changes, so draw order is the same every frame and runs of
+	the same state are drawn with one glDrawArrays
+	"""
+	
+	def __init__(self):
+		# {(layer, blend, alpha, texture): array of x, y, u, v floats}
+		self.items = {}
+		self.layer = 0
+		self.blend = BLEND_ALPHA
+		self.alpha = 1.0
+		# State changes this frame, and in the last finished frame
+		self.binds = 0
+		self.colors = 0
+		self.blends = 0
+		self.draws = 0
+		self.frame_counts = (0, 0, 0, 0)
+		
+	def set_state(self, layer=0, alpha=1.0, blend=BLEND_ALPHA):
+		"""
+		Set layer, alpha and blend function of quads added after this
+		
+		Quads of one layer are drawn in texture order, a sprite with parts
+		that must stack puts them on fractional layers
+		"""
+		self.layer = layer
+		self.alpha = alpha
+		self.blend = blend
+		
+	def add(self, texture, x, y, width, height, tex_coords, 
+			angle=0.0, scale_x=1.0):
+		"""
+		Add a quad drawn from x, y, rotated angle degrees about x, y and
+		stretched by scale_x, as glTranslate, glRotatef, glScalef would
+		"""
+		width *= scale_x
+		if angle:
+			radians = math.radians(angle)
+			cos = math.cos(radians)
+			sin = math.sin(radians)
+			corners = ((x, y), 
+					   (x + width * cos, y + width * sin),
+					   (x + width * cos - height * sin, y + width * sin + height * cos),
+					   (x - height * sin, y + height * cos))
+		else:
+			corners = ((x, y), (x + width, y), 
+					   (x + width, y + height), (x, y + height))
+		key = (self.layer, self.blend, self.alpha, texture)
+		try:
+			vertices = self.items[key]
+		except KeyError:
+			vertices = self.items[key] = array('f')
+		# Two triangles, 0 1 2 and 2 3 0
+		for i in (0, 1, 2, 2, 3, 0):
+			vertices.extend(corners[i])
+			vertices.extend(tex_coords[i])
+		
+	def flush(self):
+		"""Draw and clear queued quads, leaving default blend and colour"""
+		if not self.items:
+			glColor4f(1.0, 1.0, 1.0, 1.0)
+			return
+		vertices = array('f')
+		# [[blend, alpha, texture, first vertex, vertex count], ...]
+		ranges = []
+		state = None
+		for key in sorted(self.items):
+			first = len(vertices) / VERTEX_SIZE
+			vertices.extend(self.items[key])
+			count = len(vertices) / VERTEX_SIZE - first
+			# Layers drawn with the same state run on in one range
+			if key[1:] == state:
+				ranges[-1][4] += count
+			else:
+				state = key[1:]
+				ranges.append([key[1], key[2], key[3], first, count])
+		self.items = {}
+		
+		vertex_data = vertices.tostring()
+		buffer_ = ctypes.create_string_buffer(vertex_data, len(vertex_data))
+		address = ctypes.addressof(buffer_)
+		glMatrixMode(GL_MODELVIEW)
+		glLoadIdentity()
+		glEnableClientState(GL_VERTEX_ARRAY)
+		glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+		glVertexPointer(2, GL_FLOAT, VERTEX_STRIDE, ctypes.c_void_p(address))
+		glTexCoordPointer(2, GL_FLOAT, VERTEX_STRIDE, ctypes.c_void_p(address + 8))
+		current_blend = BLEND_ALPHA
+		current_alpha = None
+		current_texture = None
+		for blend, alpha, texture, first, count in ranges:
+			if blend != current_blend:
+				glBlendFunc(*blend)
+				current_blend = blend
+				self.blends += 1
+			if alpha != current_alpha:
+				glColor4f(1.0, 1.0, 1.0, alpha)
+				current_alpha = alpha
+				self.colors += 1
+			if texture != current_texture:
+				glBindTexture(GL_TEXTURE_2D, texture)
+				current_texture = texture
+				self.binds += 1
+			glDrawArrays(GL_TRIANGLES, first, count)
+			self.draws += 1
+		glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+		glDisableClientState(GL_VERTEX_ARRAY)
+		if current_blend != BLEND_ALPHA:
+			glBlendFunc(*BLEND_ALPHA)
+		if current_alpha != 1.0:
+			glColor4f(1.0, 1.0, 1.0, 1.0)
+		self.set_state()
+		
+	def end_frame(self):
+		"""Keep this frame's state change counts and start counting again"""
+		self.frame_counts = (self.binds, self.colors, self.blends, self.draws)
+		self.binds = 0
+		self.colors = 0
+		self.blends = 0
+		self.draws = 0
+		
+	def report(self):
+		print "Render queue: %d binds, %d colour changes, %d blend changes, %d draws" % self.frame_counts
+
 class ModelManage:
 
 	def __init__(self):
+		# Quads by (name or texture, width, height, tex_coords)
 		self.models = {}
 		
+	def forget_model(self, gl_list):
+		"""Drop cache entries of a deleted display list"""
+		for name, model in self.models.items():
+			if model == gl_list:
+				del self.models[name]
+		
+	def quad_key(self, name, width, height, tex_coords):
+		"""Return cache key of a quad, tex_coords as a tuple of tuples"""
+		if tex_coords is None:
+			tex_coords = QUAD_TEX_COORDS
+		return (name, width, height, tuple([tuple(coord) for coord in tex_coords]))
+		
 	def untextured_quad(self, name, width, height, tex_coords=None):
-		model_name = "%s-%s-%s" % (name, width, height)
+		model_name = self.quad_key(name, width, height, tex_coords)
 		try:
-			return self.models[model_name]
+			gl_list = self.models[model_name]
 		except KeyError:
-			if tex_coords is None:
-				tex_coords = ((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0))
+			tex_coords = model_name[3]
 			gl_list = glGenLists(1)
 			glNewList(gl_list, GL_COMPILE)
 			glBegin(GL_QUADS)
@@ -55,15 +265,21 @@ class ModelManage:
 			glEndList()
 
 			self.models[model_name] = gl_list
+			resources.add('list', gl_list, QUAD_LIST_SIZE, on_delete=self.forget_model)
+			asset_stats.miss('quad', QUAD_LIST_SIZE)
 			return gl_list
+		asset_stats.hit('quad')
+		return gl_list
 	
-	def textured_quad(self, texture, width, height, tex_coords=None):
-		model_name = "%s-%s-%s" % (texture, width, height)
+	def textured_quad(self, texture, width, height, tex_coords=None, owner=None):
+		model_name = self.quad_key(texture, width, height, tex_coords)
 		try:
-			return self.models[model_name]
+			gl_list = self.models[model_name]
+			asset_stats.hit('quad')
+			resources.use('list', gl_list, owner)
+			return gl_list
 		except KeyError:
-			if tex_coords is None:
-				tex_coords = ((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0))
+			tex_coords = model_name[3]
 			gl_list = glGenLists(1)
 			glNewList(gl_list, GL_COMPILE)
 			glBindTexture(GL_TEXTURE_2D, texture)
@@ -80,42 +296,238 @@ class ModelManage:
 			glEndList()
 
 			self.models[model_name] = gl_list
+			resources.add('list', gl_list, QUAD_LIST_SIZE, owner, self.forget_model)
+			asset_stats.miss('quad', QUAD_LIST_SIZE)
 			return gl_list
 		
-	def tiled_quads(self, name, tile_list):
+	def render_texture(self, width, height, view_width, view_height, draw, owner=None):
+		"""
+		Render draw() into a new width x height texture held by owner
+		
+		0, 0 to view_width, view_height is scaled to fit the texture. Colour
+		ends up premultiplied by alpha, so draw the texture blended with
+		GL_ONE, GL_ONE_MINUS_SRC_ALPHA. Return None without framebuffer
+		object support
+		"""
+		if not bool(glGenFramebuffers) or not bool(glBlendFuncSeparate):
+			return None
+		texture = glGenTextures(1)
+		glBindTexture(GL_TEXTURE_2D, texture)
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, 
+					 GL_UNSIGNED_BYTE, None)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+		
+		bound = glGetIntegerv(GL_FRAMEBUFFER_BINDING)
+		framebuffer = glGenFramebuffers(1)
+		glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+		glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, texture, 0)
+		glPushAttrib(GL_CURRENT_BIT | GL_VIEWPORT_BIT | GL_COLOR_BUFFER_BIT | GL_ENABLE_BIT)
+		glViewport(0, 0, width, height)
+		glDisable(GL_DEPTH_TEST)
+		glClearColor(0.0, 0.0, 0.0, 0.0)
+		glClear(GL_COLOR_BUFFER_BIT)
+		glBlendFuncSeparate(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA, GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+		glColor4f(1.0, 1.0, 1.0, 1.0)
+		glMatrixMode(GL_PROJECTION)
+		glPushMatrix()
+		glLoadIdentity()
+		glOrtho(0.0, view_width, 0.0, view_height, -1.0, 1.0)
+		glMatrixMode(GL_MODELVIEW)
+		glPushMatrix()
+		glLoadIdentity()
+		
+		draw()
+		
+		glPopMatrix()
+		glMatrixMode(GL_PROJECTION)
+		glPopMatrix()
+		glMatrixMode(GL_MODELVIEW)
+		glPopAttrib()
+		glBindFramebuffer(GL_FRAMEBUFFER, bound)
+		glDeleteFramebuffers(1, [framebuffer])
+		resources.add('texture', texture, width * height * 4, owner)
+		return texture
+		
+	def cull_tiles(self, tile_list, opacity, cell_size=32):
+		"""
+		Drop tiles completely hidden by opaque tiles drawn after them
+		
+		tile_list is in the format [(x, y, width, height, texture), ...] in
+		draw order, opacity maps textures to OpacityMaps. Coverage is kept on a
+		grid of cell_size cells, a cell only counts as covered once it lies
+		inside an opaque part of a tile, so culling is conservative.
+		"""
+		covered = set()
+		kept = []
+		for tile in reversed(tile_list):
+			x, y, width, height, texture = tile
+			right = x + width
+			top = y + height
+			hidden = True
+			for cell_x in range(int(math.floor(float(x) / cell_size)), int(math.ceil(float(right) / cell_size))):
+				for cell_y in range(int(math.floor(float(y) / cell_size)), int(math.ceil(float(top) / cell_size))):
+					if (cell_x, cell_y) not in covered:
+						hidden = False
+						break
+				if not hidden:
+					break
+			if hidden:
+				continue
+			kept.append(tile)
+			
+			# Cells inside the tile where its texture is opaque
+			texture_opacity = opacity.get(texture)
+			if texture_opacity is None:
+				continue
+			scale_x = float(texture_opacity.width) / width
+			scale_y = float(texture_opacity.height) / height
+			for cell_x in range(int(math.ceil(float(x) / cell_size)), int(math.floor(float(right) / cell_size))):
+				left = cell_x * cell_size - x
+				for cell_y in range(int(math.ceil(float(y) / cell_size)), int(math.floor(float(top) / cell_size))):
+					if (cell_x, cell_y) in covered:
+						continue
+					bottom = cell_y * cell_size - y
+					if texture_opacity.covers(left * scale_x, bottom * scale_y,
+											  (left + cell_size) * scale_x,
+											  (bottom + cell_size) * scale_y):
+						covered.add((cell_x, cell_y))
+		kept.reverse()
+		return kept
+	
+	def overdraw(self, tile_list, width, height):
+		"""Return area of tiles inside width x height over the area itself"""
+		area = 0.0
+		for tile in tile_list:
+			x, y, tile_width, tile_height = tile[:4]
+			area += max(min(x + tile_width, width) - max(x, 0), 0) * \
+					max(min(y + tile_height, height) - max(y, 0), 0)
+		return area / (width * height)
+	
+	def merge_tiles(self, tile_list):
+		"""
+		Merge runs of identical tiles into quads with repeating tex coords
+		
+		tile_list is in the format [(x, y, width, height, region), ...] in
+		draw order, returns [(x, y, width, height, region, repeat_x, repeat_y), ...]
+		A tile is only merged into an earlier quad if nothing drawn between
+		them overlaps it, so the result looks the same. Regions of an atlas
+		can't repeat so they aren't merged
+		"""
+		quads = [(x, y, width, height, texture, 1, 1) for x, y, width, height, texture in tile_list]
+		return self.merge_runs(self.merge_runs(quads, 0), 1)
+	
+	def merge_runs(self, quads, axis):
+		"""Merge quads with their neighbours along axis 0 (x) or 1 (y)"""
+		merged = []
+		# Run index by the (position, size, texture, repeat) a neighbour would have
+		run_ends = {}
+		for quad in quads:
+			x, y, width, height, texture, repeat_x, repeat_y = quad
+			if texture[1:] != WHOLE_TEXTURE:
+				merged.append(quad)
+				continue
+			if axis == 0:
+				key = (x, y, width / repeat_x, height, texture, repeat_y)
+			else:
+				key = (x, y, width, height / repeat_y, texture, repeat_x)
+			index = run_ends.pop(key, None)
+			if index is not None:
+				for between in merged[index + 1:]:
+					if between[0] < x + width and between[0] + between[2] > x and \
+					   between[1] < y + height and between[1] + between[3] > y:
+						index = None
+						break
+			if index is None:
+				index = len(merged)
+				merged.append(quad)
+			else:
+				run_x, run_y, run_width, run_height, texture, repeat_x, repeat_y = merged[index]
+				if axis == 0:
+					run_width += width
+					repeat_x += quad[5]
+				else:
+					run_height += height
+					repeat_y += quad[6]
+				merged[index] = (run_x, run_y, run_width, run_height, texture, repeat_x, repeat_y)
+			run_x, run_y, run_width, run_height, texture, repeat_x, repeat_y = merged[index]
+			if axis == 0:
+				run_ends[(run_x + run_width, run_y, run_width / repeat_x, run_height, texture, repeat_y)] = index
+			else:
+				run_ends[(run_x, run_y + run_height, run_width, run_height / repeat_y, texture, repeat_x)] = index
+		return merged
+		
+	def group_tiles(self, tile_list):
+		"""
+		Return [(texture, [tile, ...]), ...] with tiles moved into an earlier
+		group of the same texture when nothing drawn in between overlaps them
+		"""
+		groups = []
+		for tile in tile_list:
+			x, y, width, height = tile[:4]
+			texture = tile[4][0]
+			target = None
+			for group in reversed(groups):
+				if group[0] == texture:
+					target = group
+					break
+				overlaps = False
+				for other in group[1]:
+					if other[0] < x + width and other[0] + other[2] > x and \
+					   other[1] < y + height and other[1] + other[3] > y:
+						overlaps = True
+						break
+				if overlaps:
+					break
+			if target is None:
+				target = (texture, [])
+				groups.append(target)
+			target[1].append(tile)
+		return groups
+		
+	def tiled_mesh(self, name, tile_list, owner=None):
 		"""
-		Return GL display model for a glBindTexture object
+		Return TileMesh held by owner for a list of tiles
 		
-		tile_list is in the format [(x, y, width, height, texture), ...]
-		these display lists should all be unique, so don't save to self.models
+		tile_list is in the format [(x, y, width, height, region), ...] or
+		[(x, y, width, height, region, repeat_x, repeat_y), ...] for merged
+		tiles, region is (texture, u1, v1, u2, v2). Tex coords are inset by
+		TILE_INSET of the region. Every mesh is unique, so they aren't kept
+		in self.models
 		"""
 		if len(tile_list) < 1:
 			return False
-		tex_coords = ((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0))
 		
-		gl_list = glGenLists(1)
-		glNewList(gl_list, GL_COMPILE)
-		for tile in tile_list:
-			x = float(tile[0])
-			y = float(tile[1])
-			width = float(tile[2])
-			height = float(tile[3])
-			texture = tile[4]
-			
-			glPushMatrix()
-			glTranslate(x, y, 0.0)
-			glBindTexture(GL_TEXTURE_2D, texture)
-			glBegin(GL_QUADS)
-			glTexCoord2f(tex_coords[0][0], tex_coords[0][1])
-			glVertex3f(0.0, 0.0, 0.0)
-			glTexCoord2f(tex_coords[1][0], tex_coords[1][1])
-			glVertex3f(width, 0.0, 0.0)
-			glTexCoord2f(tex_coords[2][0], tex_coords[2][1])
-			glVertex3f(width,  height, 0.0)
-			glTexCoord2f(tex_coords[3][0], tex_coords[3][1])
-			glVertex3f(0.0,  height, 0.0)
-			glEnd()
-			glPopMatrix()
-		glEndList()
-
-		return gl_list
+		vertices = array('f')
+		ranges = []
+		for texture, tiles in self.group_tiles(tile_list):
+			first = len(vertices) / VERTEX_SIZE
+			for tile in tiles:
+				x, y, width, height, region = tile[:5]
+				u1, v1, u2, v2 = region[1:]
+				inset_u = (u2 - u1) * TILE_INSET
+				inset_v = (v2 - v1) * TILE_INSET
+				if len(tile) > 5:
+					u2 = u1 + (u2 - u1) * tile[5]
+					v2 = v1 + (v2 - v1) * tile[6]
+				u1 += inset_u
+				v1 += inset_v
+				u2 -= inset_u
+				v2 -= inset_v
+				right = x + width
+				top = y + height
+				vertices.extend((x, y, u1, v1,
+								 right, y, u2, v1,
+								 right, top, u2, v2,
+								 right, top, u2, v2,
+								 x, top, u1, v2,
+								 x, y, u1, v1))
+			ranges.append((texture, first, len(vertices) / VERTEX_SIZE - first))
+		asset_stats.miss('mesh', len(vertices) * vertices.itemsize)
+		return TileMesh(vertices.tostring(), ranges, owner)
+		
+		
+# The one ModelManage every module builds models through
+model_manager = ModelManage()
@@ -0,0 +1,225 @@
+"""
+Copyright 2008 Ryan Hoffman
+
+This file is part of Robot Toast.
+
+Robot Toast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Robot Toast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
+"""
+#------------------------------------------------------------------------------
+#   Imports
+#------------------------------------------------------------------------------
+
+import sys
+import types
+
+
+#------------------------------------------------------------------------------
+#   Globals
+#------------------------------------------------------------------------------
+
+# Enums used by the game, same values as OpenGL.GL
+CONSTANTS = {
+	'GL_ZERO': 0x0000,
+	'GL_ONE': 0x0001,
+	'GL_TRIANGLES': 0x0004,
+	'GL_QUADS': 0x0007,
+	'GL_CURRENT_BIT': 0x00000001,
+	'GL_DEPTH_BUFFER_BIT': 0x00000100,
+	'GL_VIEWPORT_BIT': 0x00000800,
+	'GL_ENABLE_BIT': 0x00002000,
+	'GL_COLOR_BUFFER_BIT': 0x00004000,
+	'GL_LEQUAL': 0x0203,
+	'GL_SRC_ALPHA': 0x0302,
+	'GL_ONE_MINUS_SRC_ALPHA': 0x0303,
+	'GL_CURRENT_COLOR': 0x0B00,
+	'GL_DEPTH_TEST': 0x0B71,
+	'GL_VIEWPORT': 0x0BA2,
+	'GL_BLEND': 0x0BE2,
+	'GL_MAX_TEXTURE_SIZE': 0x0D33,
+	'GL_TEXTURE_2D': 0x0DE1,
+	'GL_COMPILE': 0x1300,
+	'GL_UNSIGNED_BYTE': 0x1401,
+	'GL_FLOAT': 0x1406,
+	'GL_MODELVIEW': 0x1700,
+	'GL_PROJECTION': 0x1701,
+	'GL_RGB': 0x1907,
+	'GL_RGBA': 0x1908,
+	'GL_SMOOTH': 0x1D01,
+	'GL_NEAREST': 0x2600,
+	'GL_LINEAR': 0x2601,
+	'GL_TEXTURE_MAG_FILTER': 0x2800,
+	'GL_TEXTURE_MIN_FILTER': 0x2801,
+	'GL_TEXTURE_WRAP_S': 0x2802,
+	'GL_TEXTURE_WRAP_T': 0x2803,
+	'GL_VERTEX_ARRAY': 0x8074,
+	'GL_TEXTURE_COORD_ARRAY': 0x8078,
+	'GL_CLAMP_TO_EDGE': 0x812F,
+	'GL_ARRAY_BUFFER': 0x8892,
+	'GL_STATIC_DRAW': 0x88E4,
+	'GL_FRAMEBUFFER_BINDING': 0x8CA6,
+	'GL_COLOR_ATTACHMENT0': 0x8CE0,
+	'GL_FRAMEBUFFER': 0x8D40,
+	}
+
+# Calls that only change state the game never reads back
+FUNCTIONS = (
+	'glBegin', 'glBindBuffer', 'glBindTexture', 'glBlendFunc',
+	'glBlendFuncSeparate', 'glBufferData', 'glCallList', 'glClear',
+	'glClearColor', 'glClearDepth', 'glCopyTexSubImage2D', 'glDeleteBuffers',
+	'glDeleteFramebuffers', 'glDeleteLists', 'glDeleteTextures', 'glDepthFunc',
+	'glDisable', 'glDisableClientState', 'glDrawArrays', 'glEnable',
+	'glEnableClientState', 'glEnd', 'glEndList', 'glFinish', 'glFlush',
+	'glFramebufferTexture2D', 'glLoadIdentity', 'glLoadMatrixd',
+	'glMatrixMode', 'glNewList', 'glOrtho', 'glPopMatrix', 'glPushMatrix',
+	'glRotatef', 'glScalef', 'glShadeModel', 'glTexCoord2f',
+	'glTexCoordPointer', 'glTexImage2D', 'glTexParameteri', 'glTranslate',
+	'glVertex3f', 'glVertexPointer',
+	)
+
+# Reported by glGetIntegerv(GL_MAX_TEXTURE_SIZE)
+MAX_TEXTURE_SIZE = 4096
+
+
+#------------------------------------------------------------------------------
+#   Null GL
+#------------------------------------------------------------------------------
+
+class NullGL:
+	"""
+	OpenGL that draws nothing
+
+	Counts calls by function and keeps the little state the game reads
+	back: the current colour, the viewport and the bound framebuffer.
+	Names are handed out by glGen* so textures, lists and buffers stay
+	distinct
+	"""
+
+	def __init__(self):
+		# {function name: calls}
+		self.calls = {}
+		self.names = 0
+		self.color = (1.0, 1.0, 1.0, 1.0)
+		self.viewport = (0, 0, 0, 0)
+		self.framebuffer = 0
+		# (color, viewport) saved by glPushAttrib
+		self.attrib_stack = []
+
+	def count(self, name):
+		self.calls[name] = self.calls.get(name, 0) + 1
+
+	def function(self, name):
+		"""Return a function that only counts its calls"""
+		def call(*args):
+			self.count(name)
+		call.__name__ = name
+		return call
+
+	def gen_names(self, name):
+		"""Return a glGen* function, n names in a row from the first returned"""
+		def gen(n=1):
+			self.count(name)
+			first = self.names + 1
+			self.names += n
+			return first
+		gen.__name__ = name
+		return gen
+
+	def glColor4f(self, red, green, blue, alpha):
+		self.count('glColor4f')
+		self.color = (red, green, blue, alpha)
+
+	def glViewport(self, x, y, width, height):
+		self.count('glViewport')
+		self.viewport = (x, y, width, height)
+
+	def glBindFramebuffer(self, target, framebuffer):
+		self.count('glBindFramebuffer')
+		self.framebuffer = framebuffer
+
+	def glPushAttrib(self, mask):
+		self.count('glPushAttrib')
+		self.attrib_stack.append((self.color, self.viewport))
+
+	def glPopAttrib(self):
+		self.count('glPopAttrib')
+		self.color, self.viewport = self.attrib_stack.pop()
+
+	def glGetFloatv(self, pname):
+		self.count('glGetFloatv')
+		if pname == CONSTANTS['GL_CURRENT_COLOR']:
+			return list(self.color)
+		if pname == CONSTANTS['GL_VIEWPORT']:
+			return [float(value) for value in self.viewport]
+		return [0.0]
+
+	def glGetIntegerv(self, pname):
+		self.count('glGetIntegerv')
+		if pname == CONSTANTS['GL_MAX_TEXTURE_SIZE']:
+			return MAX_TEXTURE_SIZE
+		if pname == CONSTANTS['GL_FRAMEBUFFER_BINDING']:
+			return self.framebuffer
+		if pname == CONSTANTS['GL_VIEWPORT']:
+			return list(self.viewport)
+		return 0
+
+	def glGetError(self):
+		return 0
+
+	def gl_namespace(self):
+		"""Return {name: value} standing in for OpenGL.GL"""
+		namespace = dict(CONSTANTS)
+		for name in FUNCTIONS:
+			namespace[name] = self.function(name)
+		for name in ('glGenTextures', 'glGenLists', 'glGenBuffers', 'glGenFramebuffers'):
+			namespace[name] = self.gen_names(name)
+		for name in ('glColor4f', 'glViewport', 'glBindFramebuffer', 'glPushAttrib',
+					 'glPopAttrib', 'glGetFloatv', 'glGetIntegerv', 'glGetError'):
+			namespace[name] = getattr(self, name)
+		return namespace
+
+	def reset(self):
+		self.calls = {}
+
+	def report(self, frames=1):
+		"""Print calls per frame, most called first"""
+		calls = sorted(self.calls.items(), key=lambda item: item[1], reverse=True)
+		for name, count in calls:
+			print "%s: %.2f" % (name, float(count) / frames)
+
+
+def install():
+	"""
+	Make OpenGL, OpenGL.GL and OpenGL.GLU import a NullGL
+
+	Call before importing anything from the game, modules that already
+	imported PyOpenGL keep it. Return the NullGL
+	"""
+	if 'OpenGL.GL' in sys.modules and not hasattr(sys.modules['OpenGL.GL'], 'null_gl'):
+		print "PyOpenGL was imported before the null GL was installed"
+	null_gl = NullGL()
+	package = types.ModuleType('OpenGL')
+	package.__path__ = []
+	gl = types.ModuleType('OpenGL.GL')
+	gl.__dict__.update(null_gl.gl_namespace())
+	gl.__all__ = [name for name in gl.__dict__ if name.startswith(('gl', 'GL_'))]
+	gl.null_gl = null_gl
+	glu = types.ModuleType('OpenGL.GLU')
+	glu.gluOrtho2D = null_gl.function('gluOrtho2D')
+	glu.__all__ = ['gluOrtho2D']
+	package.GL = gl
+	package.GLU = glu
+	sys.modules['OpenGL'] = package
+	sys.modules['OpenGL.GL'] = gl
+	sys.modules['OpenGL.GLU'] = glu
+	return null_gl
@@ -0,0 +1,167 @@
+"""
+Copyright 2008 Ryan Hoffman
+
+This file is part of Robot Toast.
+
+Robot Toast is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Robot Toast is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
+"""
+#------------------------------------------------------------------------------
+#   Imports
+#------------------------------------------------------------------------------
+
+from OpenGL.GL import *
+
+
+#------------------------------------------------------------------------------
+#   Globals
+#------------------------------------------------------------------------------
+
+# Bytes of resources to keep, unused resources over this are deleted least
+# recently used first. None deletes them as soon as they're unused
+RESOURCE_BUDGET = 64 * 1024 * 1024
+
+
+#------------------------------------------------------------------------------
+#   Resource Manager
+#------------------------------------------------------------------------------
+
+class ResourceManage:
+	"""
+	Reference counted GL textures, display lists and buffers
+	
+	Resources are keyed by kind ('texture', 'list' or 'buffer') and GL
+	handle, and held by owners. An owner is a game state or level that
+	is released when it stops, or None for resources kept for the whole
+	run. Resources nobody holds are deleted, or kept to be used again
+	while the total size stays under budget.
+	"""
+	
+	def __init__(self, budget=None):
+		# {(kind, handle): [size, {owner: count}, last used, on_delete]}
+		self.resources = {}
+		# Keys of resources with no owners
+		self.unused = set()
+		self.budget = budget
+		self.size = 0
+		self.clock = 0
+		
+	def add(self, kind, handle, size, owner=None, on_delete=None):
+		"""
+		Track a new resource held by owner
+		
+		on_delete(handle) is called when it's deleted, so caches can
+		forget it
+		"""
+		key = (kind, handle)
+		if key in self.resources:
+			# The handle of a resource deleted behind our back was reused
+			old_size, owners, last_used, old_on_delete = self.resources[key]
+			self.size -= old_size
+			self.unused.discard(key)
+			if old_on_delete is not None:
+				old_on_delete(handle)
+		self.clock += 1
+		self.resources[key] = [size, {owner: 1}, self.clock, on_delete]
+		self.size += size
+		self.evict()
+		
+	def use(self, kind, handle, owner=None):
+		"""Add a reference from owner to a cached resource"""
+		try:
+			resource = self.resources[(kind, handle)]
+		except KeyError:
+			return
+		self.clock += 1
+		resource[1][owner] = resource[1].get(owner, 0) + 1
+		resource[2] = self.clock
+		self.unused.discard((kind, handle))
+		
+	def release(self, owner):
+		"""Drop every reference held by owner"""
+		for key, resource in self.resources.items():
+			if owner in resource[1]:
+				del resource[1][owner]
+				if not resource[1]:
+					self.unused.add(key)
+		self.evict()
+		
+	def evict(self):
+		"""Delete unused resources, least recently used first, until under budget"""
+		if self.budget is None:
+			for key in list(self.unused):
+				self.delete(*key)
+			return
+		if self.size <= self.budget or not self.unused:
+			return
+		unused = [(self.resources[key][2], key) for key in self.unused]
+		unused.sort()
+		for last_used, key in unused:
+			if self.size <= self.budget:
+				break
+			self.delete(*key)
+			
+	def delete(self, kind, handle):
+		"""Delete a resource now, whoever holds it"""
+		try:
+			size, owners, last_used, on_delete = self.resources.pop((kind, handle))
+		except KeyError:
+			return
+		self.unused.discard((kind, handle))
+		self.size -= size
+		if on_delete is not None:
+			on_delete(handle)
+		if kind == 'texture':
+			glDeleteTextures([handle])
+		elif kind == 'list':
+			glDeleteLists(handle, 1)
+		elif kind == 'buffer':
+			glDeleteBuffers(1, [handle])
+			
+	def report(self):
+		"""Print live resource counts and bytes by kind"""
+		kinds = {}
+		for (kind, handle), resource in self.resources.items():
+			count, size = kinds.get(kind, (0, 0))
+			kinds[kind] = (count + 1, size + resource[0])
+		for kind in sorted(kinds):
+			count, size = kinds[kind]
+			print "%s: %d live, %.1fKB" % (kind, count, size / 1024.0)
+		print "%d unused, %.1fMB of %s" % (len(self.unused), self.size / 1048576.0,
+			"no budget" if self.budget is None else "%.1fMB" % (self.budget / 1048576.0))
+
+
+class AssetStats:
+	"""Cache hits, misses and bytes loaded by asset type"""
+	
+	def __init__(self):
+		# {asset type: [hits, misses, bytes]}
+		self.counts = {}
+		
+	def hit(self, kind):
+		self.counts.setdefault(kind, [0, 0, 0])[0] += 1
+		
+	def miss(self, kind, size=0):
+		counts = self.counts.setdefault(kind, [0, 0, 0])
+		counts[1] += 1
+		counts[2] += size
+		
+	def report(self):
+		for kind in sorted(self.counts):
+			hits, misses, size = self.counts[kind]
+			print "%s: %d hits, %d misses, %.1fKB loaded" % (kind, hits, misses, size / 1024.0)
+
+
+# Shared by every manager, so counts cover the whole game
+resources = ResourceManage(RESOURCE_BUDGET)
+asset_stats = AssetStats()
@@ -20,9 +20,11 @@ along with Robot Toast.  If not, see <http://www.gnu.org/licenses/>.
 #   Imports
 #------------------------------------------------------------------------------
 
-import os, math, random
-from model_manager import ModelManage
-from media_manager import MediaManage
+import os, math, random, time
+from model_manager import model_manager, RenderQueue, BLEND_ALPHA
+from media_manager import media_manager
+from resource_manager import resources
+from level_data import SOLID, KILL, NOGRAPPLE
 import pygame
 from pygame.locals import *
 from OpenGL.GL import *
@@ -32,18 +34,10 @@ from OpenGL.GL import *
 #   Globals
 #------------------------------------------------------------------------------
 
-model_manager = ModelManage()
-media_manager = MediaManage()
+render_queue = RenderQueue()
 
-def power2(x):
-	"""
-	power2(x) -> nearest power of two
-
-    Calculate the nearest power of two that is equal
-    or greater than x
-    """
-	p = math.log(x) / math.log(2)
-	return 2 ** int(math.ceil(p))
+QUAD_TEX_COORDS = ((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0))
+FLIPPED_TEX_COORDS = ((1.0, 0.0), (0.0, 0.0), (0.0, 1.0), (1.0, 1.0))
 
 
 #------------------------------------------------------------------------------
@@ -84,6 +78,9 @@ class GLSprite(pygame.sprite.Sprite, BaseEntity):
 		self.vy = 0.0
 		self.facing = 0.0
 		self.model = None
+		# Texture and tex coords of the model, for the render queue
+		self.texture = None
+		self.tex_coords = QUAD_TEX_COORDS
 
 	def update(self, interval):
 		pygame.sprite.Sprite.update(self)
@@ -97,57 +94,200 @@ class GLSprite(pygame.sprite.Sprite, BaseEntity):
 		glTranslate(self.x, self.y, 0.0)
 		glCallList(self.model)
 
+	def queue(self, queue):
+		"""Add quad to render queue, sprites without a texture draw straight away"""
+		if self.texture is None:
+			self.draw()
+		else:
+			queue.add(self.texture, self.x, self.y, self.width, self.height, 
+					  self.tex_coords)
+
 
 class GLSpriteGroup(pygame.sprite.Group):
 
 	def __init__(self, *args):
 		pygame.sprite.Group.__init__(self, *args)
 
-	def draw(self, camera=False):
-		if camera:
-			for sprite in self:
-				if camera.sprite_in_view(sprite):
-					sprite.draw()
-		else:
-			[sprite.draw() for sprite in self]
+	def queue(self, layer=0, alpha=1.0, blend=BLEND_ALPHA, camera=False):
+		"""Add sprites to the render queue, drawn by render_queue.flush()"""
+		render_queue.set_state(layer, alpha, blend)
+		for sprite in self:
+			if not camera or camera.sprite_in_view(sprite):
+				sprite.queue(render_queue)
+
+	def draw(self, camera=False, alpha=1.0):
+		"""Queue sprites and draw them straight away"""
+		self.queue(alpha=alpha, camera=camera)
+		render_queue.flush()
 
 			
 class LevelPages(object):
+	"""
+	Level pages built on demand around the camera
+	
+	build_page(x, y) returns a TilePage or None. Pages are built when the
+	camera nears them and one at a time ahead of it along its velocity.
+	A frame builds pages for up to build_time seconds, at least one if any
+	is missing, pages in view that miss out aren't drawn until they're
+	built. Once the page meshes pass budget bytes, the least recently used
+	pages are deleted, to be built again when they're next needed. Pages
+	drawn this frame are never deleted, so the budget is soft: it's passed
+	while more pages than fit are in view.
 	
-	def __init__(self, level_page_data):
-		# data is two dimensional array of sprites
-		self.data = level_page_data
-		self.length_x = len(self.data)
-		self.length_y = len(self.data[0])
+	Pages in view are found from the camera's zoomed view. Zoomed out so
+	that a level pixel is smaller than impostor_scale screen pixels, pages
+	are drawn as impostor textures of half their size.
+	"""
+	
+	def __init__(self, length_x, length_y, page_size, build_page, budget, lookahead=500.0,
+				 impostor_scale=0.75, build_time=0.004):
+		self.length_x = length_x
+		self.length_y = length_y
+		self.page_size = page_size
+		self.build_page = build_page
+		self.budget = budget
+		self.build_time = build_time
+		# Pages built this frame and when it started drawing
+		self.builds = 0
+		self.frame_start = 0.0
+		# Milliseconds of camera movement to prefetch pages for
+		self.lookahead = lookahead
+		# TilePage or None by (x, y) of built pages
+		self.pages = {}
+		# Frame each page was last wanted by (x, y)
+		self.used = {}
+		self.frame = 0
+		self.impostor_scale = impostor_scale
+		# Bytes of built page meshes and impostors
+		self.size = 0
+		
+	def around(self, x, y):
+		"""Return (x, y) of the pages in the 3x3 block around page x, y"""
+		return [(page_x, page_y) 
+				for page_x in range(max(x - 1, 0), min(x + 2, self.length_x))
+				for page_y in range(max(y - 1, 0), min(y + 2, self.length_y))]
+		
+	def in_rect(self, left, bottom, right, top):
+		"""Return (x, y) of the pages overlapping a rect"""
+		size = float(self.page_size)
+		return [(page_x, page_y)
+				for page_x in range(max(int(math.floor(left / size)), 0), 
+									min(int(math.floor(right / size)) + 1, self.length_x))
+				for page_y in range(max(int(math.floor(bottom / size)), 0),
+									min(int(math.floor(top / size)) + 1, self.length_y))]
+		
+	def page(self, x, y):
+		"""Return page x, y, building it if needed"""
+		self.used[(x, y)] = self.frame
+		try:
+			return self.pages[(x, y)]
+		except KeyError:
+			page = self.build_page(x, y)
+			self.builds += 1
+			self.pages[(x, y)] = page
+			if page is not None:
+				self.size += page.memory()
+			return page
+		
+	def can_build(self):
+		"""Return True if this frame can still build a page"""
+		return self.builds == 0 or time.time() - self.frame_start < self.build_time
 		
 	def draw(self, camera):
-		currentx, currenty = camera.current_page()
-		startx = currentx - 1
-		stopx = currentx + 2
-		start_y = currenty - 1
-		stop_y = currenty + 2
-		for x in range(startx, stopx):
-			if x < 0 or x > self.length_x - 1:
-				continue
-			for y in range(start_y, stop_y):
-				if y < 0 or y > self.length_y:
-					continue
-				try:
-					sprite = self.data[x][y]
-				except IndexError:
-					continue
-				if sprite is None:
-					continue
-				if camera.sprite_in_view(sprite):
-					sprite.draw()
-					
-	def get_models(self):
-		model_list = []
-		for x in self.data:
-			for y in x:
-				model_list.append(y)
-				
-		return model_list
+		self.frame += 1
+		self.builds = 0
+		self.frame_start = time.time()
+		left, right, bottom, top = camera.get_coords(camera.limit_x, camera.limit_y)
+		
+		# Missing pages nearest the middle of the view are built first
+		size = float(self.page_size)
+		middle_x = (left + right) / 2 / size - 0.5
+		middle_y = (bottom + top) / 2 / size - 0.5
+		keys = self.in_rect(left, bottom, right, top)
+		keys.sort(key=lambda key: (key[0] - middle_x) ** 2 + (key[1] - middle_y) ** 2)
+		sprites = []
+		for key in keys:
+			if key in self.pages or self.can_build():
+				sprite = self.page(*key)
+				if sprite is not None:
+					sprites.append(sprite)
+		
+		scale = camera.width / (right - left)
+		impostors = scale < self.impostor_scale
+		if impostors:
+			for sprite in sprites:
+				if sprite.impostor is None and not self.render_impostor(sprite):
+					impostors = False
+					break
+		elif scale < 1.0 and self.impostor_scale:
+			# Zooming out, get impostors of pages coming into view ready a
+			# page a frame
+			margin = self.page_size / 2
+			for key in self.in_rect(left - margin, bottom - margin, right + margin, top + margin):
+				sprite = self.pages.get(key)
+				if sprite is not None and sprite.impostor is None:
+					self.render_impostor(sprite)
+					break
+		
+		if impostors:
+			red, green, blue, alpha = glGetFloatv(GL_CURRENT_COLOR)
+			glColor4f(red * alpha, green * alpha, blue * alpha, alpha)
+			glBlendFunc(GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+			for sprite in sprites:
+				sprite.draw_impostor()
+			glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+			glColor4f(red, green, blue, alpha)
+		else:
+			for sprite in sprites:
+				sprite.draw()
+		self.prefetch(camera)
+		self.evict()
+		
+	def render_impostor(self, sprite):
+		"""Render impostor of a page, return False if it can't"""
+		if not sprite.render_impostor(self.page_size / 2):
+			# No render to texture, stick to meshes
+			self.impostor_scale = 0.0
+			return False
+		self.size += sprite.impostor_size
+		return True
+		
+	def prefetch(self, camera):
+		"""Build one missing page near the camera or where it's heading"""
+		current_x, current_y = camera.current_page()
+		ahead_x = int((camera.centerx + camera.vx * self.lookahead) / self.page_size)
+		ahead_y = int((camera.centery + camera.vy * self.lookahead) / self.page_size)
+		wanted = self.around(current_x, current_y) + self.around(ahead_x, ahead_y)
+		for key in wanted:
+			self.used[key] = self.frame
+		if not self.can_build():
+			return
+		for key in wanted:
+			if key not in self.pages:
+				self.page(*key)
+				return
+			
+	def evict(self):
+		"""Delete the least recently used pages while over budget, sparing those in view"""
+		if self.size <= self.budget:
+			return
+		built = [key for key, page in self.pages.items() if page is not None]
+		built.sort(key=self.used.get)
+		for key in built:
+			if self.size <= self.budget or self.used[key] == self.frame:
+				break
+			page = self.pages.pop(key)
+			self.size -= page.memory()
+			page.delete()
+			
+	def delete(self):
+		"""Delete every built page"""
+		for page in self.pages.values():
+			if page is not None:
+				page.delete()
+		self.pages = {}
+		self.used = {}
+		self.size = 0
 		
 
 #------------------------------------------------------------------------------
@@ -171,13 +311,16 @@ class ColorBackground(GLSprite):
 		background.fill(color)
 		texture = media_manager.load_texture(image_name, background)
 
+		self.texture = texture
 		self.model = model_manager.textured_quad(texture, width, height)
 
 
 class ImageBackground(GLSprite):
 
-	def __init__(self, x, y, width, height, image_name=None, sub_dir='images', tile_scale=0):
+	def __init__(self, x, y, width, height, image_name=None, sub_dir='images', tile_scale=0,
+				 owner=None):
 		GLSprite.__init__(self)
+		self.name = image_name
 
 		# Position and orientation
 		self.x = x
@@ -185,18 +328,20 @@ class ImageBackground(GLSprite):
 		self.width = width
 		self.height = height
 
-		image_obj = media_manager.load_image(image_name, sub_dir)
+		texture = media_manager.load_texture(image_name, sub_dir=sub_dir, owner=owner)
 		if tile_scale:
-			s = (float(self.width) / tile_scale) / image_obj.get_width()
-			t = (float(self.height) / tile_scale) / image_obj.get_height()
+			image_width, image_height = media_manager.texture_size(image_name, sub_dir)
+			s = (float(self.width) / tile_scale) / image_width
+			t = (float(self.height) / tile_scale) / image_height
 		else:
 			s = 1.0
 			t = 1.0
 		tex_coords = ((0.0, 0.0), (s, 0.0), (s, t), (0.0, t))
 
 		# Load model
-		texture = media_manager.save_texture(image_name, image_obj)
-		self.model = model_manager.textured_quad(texture, width, height, tex_coords)
+		self.texture = texture
+		self.tex_coords = tex_coords
+		self.model = model_manager.textured_quad(texture, width, height, tex_coords, owner)
 
 
 class TilePage(GLSprite):
@@ -210,7 +355,46 @@ class TilePage(GLSprite):
 		self.width = width
 		self.height = height
 
+		# TileMesh
 		self.model = model
+		# Low detail texture of the page for drawing zoomed out
+		self.impostor = None
+		self.impostor_size = 0
+		
+	def draw(self):
+		"""Draw mesh"""
+		glMatrixMode(GL_MODELVIEW)
+		glLoadIdentity()
+		glTranslate(self.x, self.y, 0.0)
+		self.model.draw()
+		
+	def render_impostor(self, size):
+		"""Render the mesh to a size x size impostor, return False if it can't"""
+		self.impostor = model_manager.render_texture(size, size, self.width, self.height, 
+													 self.model.draw)
+		if self.impostor is None:
+			return False
+		self.impostor_size = size * size * 4
+		return True
+		
+	def draw_impostor(self):
+		"""Draw impostor, blended as premultiplied alpha"""
+		glMatrixMode(GL_MODELVIEW)
+		glLoadIdentity()
+		glTranslate(self.x, self.y, 0.0)
+		glBindTexture(GL_TEXTURE_2D, self.impostor)
+		glCallList(model_manager.untextured_quad('impostor', self.width, self.height))
+		
+	def memory(self):
+		"""Return bytes of mesh and impostor"""
+		return self.model.size + self.impostor_size
+		
+	def delete(self):
+		self.model.delete()
+		if self.impostor is not None:
+			resources.delete('texture', self.impostor)
+			self.impostor = None
+			self.impostor_size = 0
 
 
 class GLText(GLSprite):
@@ -231,6 +415,9 @@ class GLText(GLSprite):
 
 		self.font = media_manager.load_font(font, size)
 		self.color = color
+		self.texture, self.glyphs = media_manager.load_glyphs(font, size, color)
+		# [(x offset, width, height, tex_coords), ...] of the string's glyphs
+		self.quads = []
 		self.update_string(string)
 
 		# Reposition for alignment
@@ -244,32 +431,30 @@ class GLText(GLSprite):
 			self.y -= self.height
 
 	def update_string(self, new_string):
+		"""Lay out glyph quads, no textures or GL objects are made"""
 		# Only update new strings
 		if new_string == "" or new_string == None or self.string == new_string:
 			return
-
-		# Render font
 		self.string = str(new_string)
-		text = self.font.render(self.string, 1, self.color)
+
+		# Each glyph starts where the font puts it in the whole string
+		self.quads = []
+		for i, char in enumerate(self.string):
+			width, height, tex_coords = self.glyphs.get(char, self.glyphs['?'])
+			x = self.font.size(self.string[:i])[0]
+			self.quads.append((x, width, height, tex_coords))
 
 		# Calculate dimensions
-		rect = text.get_rect()
-		self.width = rect.width
-		self.height = rect.height
-		width_pow2 = power2(self.width)
-		height_pow2 = power2(self.height)
-		x_tex = self.width / float(width_pow2)
-		y_tex = 1.0 - (self.height / float(height_pow2))
+		self.width, self.height = self.font.size(self.string)
 
-		# Blit texture
-		surface = pygame.Surface((width_pow2, height_pow2), SRCALPHA, 32)
-		surface.blit(text, (0, 0))
-		texture = media_manager.load_texture(self.string, surface)
+	def draw(self):
+		"""Draw glyphs straight away"""
+		self.queue(render_queue)
+		render_queue.flush()
 
-		# Create model
-		tex_coords = ((0.0, y_tex), (x_tex, y_tex), (x_tex, 1.0), (0.0, 1.0))
-		self.model = model_manager.textured_quad(texture, self.width, 
-												 self.height, tex_coords)
+	def queue(self, queue):
+		for x, width, height, tex_coords in self.quads:
+			queue.add(self.texture, self.x + x, self.y, width, height, tex_coords)
 
 
 class Actor(GLSprite):
@@ -284,7 +469,9 @@ class Actor(GLSprite):
 		self.height = 0.0
 		self.gamestate = gamestate
 		self.level = self.gamestate.level
-		self.collision_properties = {}
+		# Property flags and values of touched tiles
+		self.collision_properties = 0
+		self.collision_values = {}
 
 		# Textures
 		self.texture_width = 0.0
@@ -315,46 +502,28 @@ class Actor(GLSprite):
 		glBindTexture(GL_TEXTURE_2D, self.current_texture)
 		glCallList(self.model)
 
+	def queue(self, queue):
+		x = self.x - (self.texture_width - self.width) / 2
+		y = self.y - (self.texture_height - self.height) / 2
+		queue.add(self.current_texture, x, y, self.texture_width, 
+				  self.texture_height, self.tex_coords, self.facing)
+
 	def kill(self):
 		self.vx = 0.0
 		self.vy = 0.0
 		GLSprite.kill(self)
 
-	def push_x(self, tiles):
-		x_push = 0.0
-		for tile in tiles:
-			if tile.has_property('solid'):
-				x_diff = 0.0
-				if self.vx > 0:
-					x_diff = tile.left - self.right - 0.0001
-				elif self.vx < 0:
-					x_diff = tile.right - self.left
-				if abs(x_diff) > abs(x_push):
-					x_push = x_diff
-		return x_push
-
-	def push_y(self, tiles):
-		y_push = 0.0
-		for tile in tiles:
-			if tile.has_property('solid'):
-				y_diff = 0.0
-				if self.vy < 0:
-					y_diff = tile.top - self.bottom
-				elif self.vy > 0:
-					y_diff = tile.bottom - self.top - 0.0001
-				if abs(y_diff) > abs(y_push):
-					y_push = y_diff
-		return y_push
-
-	def add_collision_properties(self, tiles):
-		"""Add properties without duplicates"""
-		for tile in tiles:
-			for property, value in tile.properties.iteritems():
-				self.collision_properties[property] = value
+	def add_collision_properties(self, flags, value):
+		"""Add property flags of touched rects and the checkpoint value, if any"""
+		self.collision_properties |= flags
+		if value is not None:
+			self.collision_values['checkpoint'] = value
 
 	def process_collision_properties(self):
-		self.gamestate.process_collision_properties(self.collision_properties, self)
-		self.collision_properties = {}
+		self.gamestate.process_collision_properties(self.collision_properties,
+													self.collision_values, self)
+		self.collision_properties = 0
+		self.collision_values.clear()
 		
 	def play_sound(self, sound_name):
 		"""Try to play a sound object in self.sounds"""
@@ -392,6 +561,30 @@ class Actor(GLSprite):
 
 class StickDude(Actor):
 
+	# Animation frames, totaltextures has all of them so a level can decode
+	# them before the dude is made
+	totaltextures = []
+	idleframes = ['ninjabot_idle_1.png']
+	totaltextures.extend(idleframes)
+	runframes = ['ninjabot_run_1.png', 'ninjabot_run_2.png', 'ninjabot_run_3.png', 'ninjabot_run_4.png', 'ninjabot_run_5.png', 'ninjabot_run_6.png', 'ninjabot_run_7.png', 'ninjabot_run_8.png', 'ninjabot_run_9.png', 'ninjabot_run_10.png', 'ninjabot_run_11.png', 'ninjabot_run_0.png']
+	totaltextures.extend(runframes)
+	wallslideframes = ['ninjabot_wallslide_0.png']
+	totaltextures.extend(wallslideframes)
+	ledgegrabframes = ['ninjabot_grab_towards.png']
+	totaltextures.extend(ledgegrabframes)
+	jumpframes = ['ninjabot_jump_0.png', 'ninjabot_jump_1.png', 'ninjabot_jump_2.png', 'ninjabot_jump_3.png', 'ninjabot_jump_4.png', 'ninjabot_jump_5.png', 'ninjabot_jump_6.png', 'ninjabot_jump_7.png', 'ninjabot_jump_8.png', 'ninjabot_jump_9.png']
+	totaltextures.extend(jumpframes)
+	jumpupframes = ['ninjabot_jumpup_0.png', 'ninjabot_jumpup_1.png', 'ninjabot_jumpup_2.png', 'ninjabot_jumpup_3.png', 'ninjabot_jumpup_4.png', 'ninjabot_jumpup_5.png', 'ninjabot_jumpup_6.png', 'ninjabot_jumpup_7.png']
+	totaltextures.extend(jumpupframes)
+	fallingupframes = ['ninjabot_fall_0.png']
+	totaltextures.extend(fallingupframes)
+	fallingframes = ['ninjabot_jump_8.png']
+	totaltextures.extend(fallingframes)
+	jetpackframes = ['ninjabot_jetpack_0.png', 'ninjabot_jetpack_1.png', 'ninjabot_jetpack_2.png', 'ninjabot_jetpack_3.png', 'ninjabot_jetpack_4.png', 'ninjabot_jetpack_5.png', 'ninjabot_jetpack_6.png', 'ninjabot_jetpack_7.png', 'ninjabot_jetpack_8.png', 'ninjabot_jetpack_9.png']
+	totaltextures.extend(jetpackframes)
+	grappleframes = ['ninjabot_swinging.png']
+	totaltextures.extend(grappleframes)
+
 	def __init__(self, gamestate):
 		Actor.__init__(self, 0.0, 0.0, gamestate)
 		# Collision attributes
@@ -429,48 +622,27 @@ class StickDude(Actor):
 		# Textures
 		self.texture_width = 64.0
 		self.texture_height = 128.0
-		totaltextures = []
-		self.idleframes = ['ninjabot_idle_1.png']
-		totaltextures.extend(self.idleframes)
-		self.runframes = ['ninjabot_run_1.png', 'ninjabot_run_2.png', 'ninjabot_run_3.png', 'ninjabot_run_4.png', 'ninjabot_run_5.png', 'ninjabot_run_6.png', 'ninjabot_run_7.png', 'ninjabot_run_8.png', 'ninjabot_run_9.png', 'ninjabot_run_10.png', 'ninjabot_run_11.png', 'ninjabot_run_0.png']
-		totaltextures.extend(self.runframes)
-		self.wallslideframes = ['ninjabot_wallslide_0.png']
-		totaltextures.extend(self.wallslideframes)
-		self.ledgegrabframes = ['ninjabot_grab_towards.png']
-		totaltextures.extend(self.ledgegrabframes)
-		self.jumpframes = ['ninjabot_jump_0.png', 'ninjabot_jump_1.png', 'ninjabot_jump_2.png', 'ninjabot_jump_3.png', 'ninjabot_jump_4.png', 'ninjabot_jump_5.png', 'ninjabot_jump_6.png', 'ninjabot_jump_7.png', 'ninjabot_jump_8.png', 'ninjabot_jump_9.png']
-		totaltextures.extend(self.jumpframes)
-		self.jumpupframes = ['ninjabot_jumpup_0.png', 'ninjabot_jumpup_1.png', 'ninjabot_jumpup_2.png', 'ninjabot_jumpup_3.png', 'ninjabot_jumpup_4.png', 'ninjabot_jumpup_5.png', 'ninjabot_jumpup_6.png', 'ninjabot_jumpup_7.png']
-		totaltextures.extend(self.jumpupframes)
-		self.fallingupframes = ['ninjabot_fall_0.png']
-		totaltextures.extend(self.fallingupframes)
-		self.fallingframes = ['ninjabot_jump_8.png']
-		totaltextures.extend(self.fallingframes)
-		self.jetpackframes = ['ninjabot_jetpack_0.png', 'ninjabot_jetpack_1.png', 'ninjabot_jetpack_2.png', 'ninjabot_jetpack_3.png', 'ninjabot_jetpack_4.png', 'ninjabot_jetpack_5.png', 'ninjabot_jetpack_6.png', 'ninjabot_jetpack_7.png', 'ninjabot_jetpack_8.png', 'ninjabot_jetpack_9.png']
-		totaltextures.extend(self.jetpackframes)
-		self.grappleframes = ['ninjabot_swinging.png']
-		totaltextures.extend(self.grappleframes)
 		self.currentframes = self.idleframes
 		self.frameindex = 0
 		self.framedelay = 0
 
 		# create texture dictionary for GL storage and shit, with texture names as keys
 		self.textures = {}
-		for tex in totaltextures:
+		for tex in self.totaltextures:
 			self.textures[tex] = media_manager.load_texture(tex)
 		self.current_texture = self.textures[self.idleframes[0]]
 
 		# Model 
 		self.model_left = model_manager.untextured_quad('stick_dude_left', self.texture_width, self.texture_height)
 		self.model_right = model_manager.untextured_quad('stick_dude_right', self.texture_width, self.texture_height, 
-														 tex_coords=((1.0, 0.0), (0.0, 0.0), (0.0, 1.0), (1.0, 1.0)))
+														 tex_coords=FLIPPED_TEX_COORDS)
 		self.model = self.model_left
 
 		# Grapple - create model, which always exists, but doesnt always draw
 		self.grapplinghook = Grapple(self, self.x, self.y, 'grapple_rod.png' )
 		
 		# Sounds
-		self.wilhelm = media_manager.load_sound('Wilhelm.ogg')
+		self.wilhelm = media_manager.load_sound('wilhelm.ogg')
 		self.wilhelm.set_volume(0.1)
 		self.sounds = {
 			"explosion": media_manager.load_sound('explosion.wav'),
@@ -491,6 +663,16 @@ class StickDude(Actor):
 			self.grapplinghook.draw()
 		Actor.draw(self)
 
+	def queue(self, queue):
+		# The queue sorts by texture within a layer, so the grapple goes half
+		# a layer down to stay behind the robot
+		if self.grapplinghook.on:
+			layer, alpha, blend = queue.layer, queue.alpha, queue.blend
+			queue.set_state(layer - 0.5, alpha, blend)
+			self.grapplinghook.queue(queue)
+			queue.set_state(layer, alpha, blend)
+		Actor.queue(self, queue)
+
 	def update(self, interval):
 		Actor.update(self, interval)
 		if interval is 0:
@@ -525,10 +707,9 @@ class StickDude(Actor):
 			self.vy = -self.terminal_velocity
 
 		# move on x axis, detect collisions and react
-		self.x += self.vx * interval
-		tiles = self.level.tile_collide(self)
-		self.add_collision_properties(tiles)
-		push_x = self.push_x(tiles)
+		self.x += self.level.sweep_x(self, self.vx * interval)
+		push_x, push_y, flags, value = self.level.collide(self, vx=self.vx)
+		self.add_collision_properties(flags, value)
 		if push_x:
 			# check for wallslide
 			self.upjump = False
@@ -544,10 +725,9 @@ class StickDude(Actor):
 			self.vx = 0
 
 		# same on y
-		self.y += self.vy * interval
-		tiles = self.level.tile_collide(self)
-		self.add_collision_properties(tiles)
-		push_y = self.push_y(tiles)
+		self.y += self.level.sweep_y(self, self.vy * interval)
+		push_x, push_y, flags, value = self.level.collide(self, vy=self.vy)
+		self.add_collision_properties(flags, value)
 		if push_y:
 			self.upjump = False
 			self.y += push_y
@@ -602,9 +782,11 @@ class StickDude(Actor):
 		if self.move_x > 0:
 			self.facing_right = True
 			self.model = self.model_right
+			self.tex_coords = FLIPPED_TEX_COORDS
 		elif self.move_x < 0:
 			self.facing_right = False
 			self.model = self.model_left
+			self.tex_coords = QUAD_TEX_COORDS
 			
 		# Sounds based on animation
 		if self.current_texture != self.prev_texture:
@@ -720,7 +902,7 @@ class StickDude(Actor):
 			xdelta = -16
 		sliding_tile = self.level.point_collide(self.centerx + xdelta, self.centery)
 		st_top = self.level.point_collide(self.centerx + xdelta, self.top)
-		if (sliding_tile and sliding_tile.has_property('solid')) or (st_top and st_top.has_property('solid')):
+		if sliding_tile & SOLID or st_top & SOLID:
 			pass
 		else:
 			self.movestate = self.falling
@@ -735,7 +917,7 @@ class StickDude(Actor):
 					bullshitfrictionnumber = 0.0018
 				self.vy += interval * bullshitfrictionnumber
 				# ledge grab check
-				if st_top.has_property('solid'):
+				if st_top & SOLID:
 					if self.grabpotential:
 						self.movestate = self.ledgegrab
 						self.vx = 0
@@ -885,6 +1067,13 @@ class Grapple(Actor):
 		glBindTexture(GL_TEXTURE_2D, self.current_texture)
 		glCallList(self.model)
 
+	def queue(self, queue):
+		x = self.x - (self.texture_width - self.width) / 2
+		y = self.y - (self.texture_height - self.height) / 2
+		queue.add(self.current_texture, x, y, self.texture_width, 
+				  self.texture_height, self.tex_coords, self.angle + 180, 
+				  self.length / 4)
+
 	def update(self, interval):
 		Actor.update(self, interval)
 		if not self.parent.hold_fire:
@@ -921,11 +1110,11 @@ class Grapple(Actor):
 
 			grab_tile = self.parent.level.point_collide(self.x, self.y)
 			if grab_tile:
-				if grab_tile.has_property('nograpple') or grab_tile.has_property('kill'):
+				if grab_tile & (NOGRAPPLE | KILL):
 					self.parent.play_sound('clink')
 					self.reset()
 					return
-				if grab_tile.has_property('solid'):
+				if grab_tile & SOLID:
 					self.latched = True
 					self.parent.movestate = self.parent.grappling
 
@@ -969,14 +1158,12 @@ class RobotParticle(Actor):
 			self.vx = -self.terminal_velocity
 
 		# move on x axis, detect collisions and react
-		tiles = self.level.tile_collide(self)
-		push_x = self.push_x(tiles)
-		push_y = self.push_y(tiles)
+		push_x, push_y, flags, value = self.level.collide(self, self.vx, self.vy)
 		if push_x or push_y:
 			self.vx = 0.0
 			self.vy = 0.0
-		self.x += self.vx * interval
-		self.y += self.vy * interval
+		self.x += self.level.sweep_x(self, self.vx * interval)
+		self.y += self.level.sweep_y(self, self.vy * interval)
 
 
 #------------------------------------------------------------------------------
@@ -1086,10 +1273,8 @@ class Camera(BaseEntity):
 		return right >= sprite.left and left <= sprite.right and \
 			   bottom <= sprite.top and top >= sprite.bottom
 
-	def get_coords(self, limit_x, limit_y, zoom=True):
-		"""Return coordinates for parallaxing backgrounds of different sizes"""
-
-		# Free movement ratio between limit and self.limit
+	def ratios(self, limit_x, limit_y):
+		"""Return free movement ratios between limit and self.limit"""
 		if self.limit_x != self.width:
 			x_ratio = (limit_x - self.width) / (self.limit_x - self.width)
 		else:
@@ -1098,6 +1283,13 @@ class Camera(BaseEntity):
 			y_ratio = (limit_y - self.height) / (self.limit_y - self.height)
 		else:
 			y_ratio = 1.0
+		return x_ratio, y_ratio
+
+	def get_coords(self, limit_x, limit_y, zoom=True):
+		"""Return coordinates for parallaxing backgrounds of different sizes"""
+
+		# Free movement ratio between limit and self.limit
+		x_ratio, y_ratio = self.ratios(limit_x, limit_y)
 		
 		# Zoom per axis
 		if zoom:
@@ -1155,6 +1347,105 @@ class Camera(BaseEntity):
 		self.zoom = 1.0
 		
 		
+class Interpolator(object):
+	"""
+	Entities drawn between their last two simulation steps
+	
+	save() records attributes of an entity before a step. From begin(blend)
+	to end() saved entities are put blend of the way from the saved values
+	to their current ones, so movement is smooth whatever the frame rate.
+	"""
+	
+	def __init__(self):
+		# {entity: (names, values)} saved before the last step
+		self.saved = {}
+		# (entity, names, values) to put back by end()
+		self.current = []
+		
+	def clear(self):
+		self.saved = {}
+		
+	def save(self, entity, names=('x', 'y')):
+		self.saved[entity] = (names, [getattr(entity, name) for name in names])
+		
+	def forget(self, entity):
+		"""Draw entity where it is, after it jumped"""
+		self.saved.pop(entity, None)
+		
+	def begin(self, blend):
+		for entity, (names, values) in self.saved.items():
+			current = [getattr(entity, name) for name in names]
+			self.current.append((entity, names, current))
+			for name, last, value in zip(names, values, current):
+				setattr(entity, name, last + (value - last) * blend)
+				
+	def end(self):
+		for entity, names, values in self.current:
+			for name, value in zip(names, values):
+				setattr(entity, name, value)
+		self.current = []
+		
+		
+class ParallaxStack(object):
+	"""
+	Background layers moving with a camera in proportion to their size
+	
+	layers are sprites, furthest first. Movement ratios and view sizes are
+	worked out up front, as the camera's limits don't change. Layers ignore
+	the camera's zoom like get_coords(zoom=False).
+	"""
+	
+	def __init__(self, camera, layers):
+		self.camera = camera
+		# [sprite, x ratio, y ratio, clamped view width, clamped view height]
+		self.layers = []
+		for sprite in layers:
+			self.add(sprite)
+			
+	def add(self, sprite):
+		"""Add a layer in front of the rest"""
+		camera = self.camera
+		x_ratio, y_ratio = camera.ratios(sprite.width, sprite.height)
+		width = camera.width
+		height = camera.height
+		if width > sprite.width:
+			width = sprite.width
+			height = width * (camera.height / float(camera.width))
+		elif height > sprite.height:
+			height = sprite.height
+			width = height * (camera.width / float(camera.height))
+		# Milliseconds spent drawing, averaged over recent frames
+		sprite.draw_time = 0.0
+		self.layers.append([sprite, x_ratio, y_ratio, width, height])
+		
+	def remove(self, sprite):
+		self.layers = [layer for layer in self.layers if layer[0] is not sprite]
+		
+	def draw(self):
+		"""Draw every layer in its own projection"""
+		camera = self.camera
+		clamp = camera.clamp
+		for sprite, x_ratio, y_ratio, width, height in self.layers:
+			start = time.time()
+			if not clamp:
+				width = camera.width
+				height = camera.height
+			left = camera.x * float(x_ratio)
+			bottom = camera.y * float(y_ratio)
+			# Same matrix as gluOrtho2D
+			glMatrixMode(GL_PROJECTION)
+			glLoadMatrixd((2.0 / width, 0.0, 0.0, 0.0,
+						   0.0, 2.0 / height, 0.0, 0.0,
+						   0.0, 0.0, -1.0, 0.0,
+						   -(left * 2.0 + width) / width, -(bottom * 2.0 + height) / height, 0.0, 1.0))
+			sprite.draw()
+			sprite.draw_time += ((time.time() - start) * 1000.0 - sprite.draw_time) * 0.1
+			
+	def report(self):
+		for sprite, x_ratio, y_ratio, width, height in self.layers:
+			print "%s: %.3fms" % (sprite.name, sprite.draw_time)
+		
+		
 class CameraFocalPoint(BaseEntity):
 	
 	def __init__(self, x, y):